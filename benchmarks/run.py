@@ -0,0 +1,189 @@
+"""ชุดวัดประสิทธิภาพของ service ด้วยข้อมูลจำลอง
+
+แต่ละขนาดข้อมูลจะรันใน process แยก (main.py โหลดข้อมูลตอน import) แล้ววัด p50/p99 ของแต่ละ endpoint
+และ peak RSS ผลลัพธ์บันทึกเป็น JSON เพื่อเปรียบเทียบกับผลครั้งก่อนได้
+ข้อมูลจำลองสร้างใน process อีกตัวก่อนเริ่ม worker ที่วัด (peak RSS จึงไม่รวมการสร้างข้อมูล) แล้วสร้าง snapshot
+ด้วย python main.py build-snapshot เหมือนตอน deploy
+
+ใช้งาน: python -m benchmarks.run --sizes 10000 100000 1000000 --output bench.json [--compare old.json]
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZES = [10, 100, 1000]
+
+
+def measure(func, iterations):
+    timings = []
+    errors = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = func()
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 500:
+            errors += 1
+    return {
+        "n": iterations,
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p99_ms": round(float(np.percentile(timings, 99)), 3),
+        "errors": errors,
+    }
+
+
+def generate_data(args):
+    """เขียน RFT 2024.csv และไฟล์ Excel สำหรับ upload ลงใน workdir (รันใน process แยกจาก worker ที่วัด)"""
+    from benchmarks.synthetic import generate_rft_history, write_upload_exports
+
+    history = generate_rft_history(args.rows, seed=args.seed)
+    history.to_csv(os.path.join(args.workdir, 'RFT 2024.csv'), index=False, encoding='utf-8-sig')
+    rng = np.random.default_rng(args.seed)
+    write_upload_exports(args.workdir, args.upload_rows, rng.choice(history['Product'].unique(), 200), seed=args.seed)
+
+
+def peak_rss_mb():
+    # ru_maxrss บน Linux นับรวม peak ของ parent ก่อน exec ใช้ VmHWM ของ process นี้ถ้ามี
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return round(int(status['VmHWM'].split()[0]) / 1024, 1)
+    except (OSError, KeyError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_worker(args):
+    from benchmarks.synthetic import upload_export_paths
+    from benchmarks.upstream_stub import start_stub
+
+    # วัดการคำนวณจริง ไม่ใช่ response cache หรือ upload cache
+    os.environ['RESPONSE_CACHE_SIZE'] = '0'
+    os.environ['UPLOAD_CACHE_MAX_BYTES'] = '0'
+    os.chdir(args.workdir)
+    sys.path.insert(0, REPO_DIR)
+    logging.disable(logging.WARNING)
+
+    start = time.perf_counter()
+    import main as service
+    startup_seconds = time.perf_counter() - start
+
+    from fastapi.testclient import TestClient
+    client = TestClient(service.app)
+    rng = np.random.default_rng(args.seed)
+    codes = service.best_run_index.product_codes().astype(object)
+
+    results = {}
+    results["rank_product"] = measure(
+        lambda: client.post('/rank_product/', json={"product_name": str(rng.choice(codes))}),
+        args.iterations,
+    )
+    for size in BATCH_SIZES:
+        results[f"rank_best_process[{size}]"] = measure(
+            lambda: client.post('/rank_best_process/', json={"product": [{"code": str(code)} for code in rng.choice(codes, size)]}),
+            max(args.iterations // 10, 5),
+        )
+
+    for name, path in upload_export_paths(args.workdir).items():
+        def upload(name=name, path=path):
+            with open(path, 'rb') as f:
+                return client.post(f'/upload-{name}/', files={"file": (os.path.basename(path), f)})
+        results[f"upload-{name}"] = measure(upload, args.upload_iterations)
+    results["combine-files"] = measure(lambda: client.post('/combine-files/'), args.upload_iterations)
+    results["append-combined-data"] = measure(lambda: client.post('/append-combined-data/'), args.upload_iterations)
+
+    # upstream จำลองบนเครื่อง แทน extruder_control
+    server, service.wip_source_url = start_stub([str(code) for code in rng.choice(codes, args.wip_codes)])
+    results["fetch_external_data"] = measure(lambda: client.get('/fetch_external_data/'), max(args.iterations // 10, 5))
+    server.shutdown()
+
+    report = {
+        "rows": args.rows,
+        "startup_s": round(startup_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "endpoints": results,
+    }
+    print(json.dumps(report))
+
+
+def compare(current, baseline):
+    print(f"{'rows':>9}  {'endpoint':<28} {'p50 ms':>10} {'baseline':>10} {'change':>8}")
+    for rows, report in current["results"].items():
+        previous = baseline.get("results", {}).get(rows)
+        if previous is None:
+            continue
+        for name, stats in report["endpoints"].items():
+            before = previous["endpoints"].get(name)
+            if before is None or not before["p50_ms"]:
+                continue
+            change = (stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+            print(f"{rows:>9}  {name:<28} {stats['p50_ms']:>10.3f} {before['p50_ms']:>10.3f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--upload-rows', type=int, default=5000)
+    parser.add_argument('--upload-iterations', type=int, default=3)
+    parser.add_argument('--wip-codes', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="ไฟล์ JSON ผลครั้งก่อนสำหรับเปรียบเทียบ")
+    parser.add_argument('--generate', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--rows', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_data(args)
+        return
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = {}
+    for rows in args.sizes:
+        workdir = tempfile.mkdtemp(prefix='rft-bench-')
+        try:
+            options = ['--rows', str(rows), '--workdir', workdir, '--iterations', str(args.iterations),
+                       '--upload-rows', str(args.upload_rows), '--upload-iterations', str(args.upload_iterations),
+                       '--wip-codes', str(args.wip_codes), '--seed', str(args.seed)]
+            # สร้างข้อมูลและ snapshot ใน process แยก ก่อนเริ่ม worker ที่วัด
+            subprocess.run([sys.executable, '-m', 'benchmarks.run', '--generate', *options], cwd=REPO_DIR, check=True)
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(REPO_DIR, 'main.py'), 'build-snapshot'], cwd=workdir,
+                           check=True, capture_output=True)
+            build_seconds = time.perf_counter() - start
+            completed = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--worker', *options],
+                                       cwd=REPO_DIR, check=True, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        report = json.loads(completed.stdout.strip().splitlines()[-1])
+        report["build_snapshot_s"] = round(build_seconds, 3)
+        results[str(rows)] = report
+        print(f"{rows:,} rows: build-snapshot {report['build_snapshot_s']}s, startup {report['startup_s']}s, "
+              f"peak RSS {report['peak_rss_mb']} MB")
+        for name, stats in report["endpoints"].items():
+            print(f"  {name:<28} p50 {stats['p50_ms']:>9.3f} ms  p99 {stats['p99_ms']:>9.3f} ms")
+
+    output = {"meta": {"python": sys.version.split()[0], "created": time.strftime('%Y-%m-%dT%H:%M:%S')}, "results": results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(output, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""วัดเวลาเริ่มต้น worker จริง (process ใหม่ที่ import main: โหลดข้อมูล + สร้าง index) แบบไม่มี snapshot และมี snapshot
+
+แต่ละรอบรันใน process แยก เวลาที่วัดจึงรวมการเริ่ม interpreter และ import library เหมือนตอนที่ uvicorn เริ่ม worker
+วัดเวลาของ python main.py build-snapshot (ขั้นตอน build/release) แยกต่างหาก
+
+ใช้งาน: python -m benchmarks.startup --rows 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# โค้ดที่รันใน worker: import main แล้วรายงานหน่วยความจำของ process
+WORKER_CODE = """
+import json, logging, resource
+logging.disable(logging.WARNING)
+import main
+status = {}
+try:
+    with open('/proc/self/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+except OSError:
+    pass
+def mb(key):
+    return round(int(status[key].split()[0]) / 1024, 1) if key in status else None
+# ru_maxrss บน Linux นับรวม peak ของ parent ก่อน exec ใช้ VmHWM ถ้ามี
+peak = mb('VmHWM') or round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+print(json.dumps({"peak_rss_mb": peak, "rss_anon_mb": mb('RssAnon'), "rss_file_mb": mb('RssFile')}))
+"""
+
+
+def run(command, workdir):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=workdir, env=env, check=True, capture_output=True, text=True)
+    return time.perf_counter() - start, completed.stdout
+
+
+def start_worker(workdir, repeat):
+    """เวลาที่น้อยที่สุดของการเริ่ม worker ใหม่ และหน่วยความจำของ worker รอบสุดท้าย"""
+    timings = []
+    for _ in range(repeat):
+        seconds, output = run([sys.executable, '-c', WORKER_CODE], workdir)
+        timings.append(seconds)
+    return min(timings), json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from benchmarks.synthetic import write_rft_history
+
+    workdir = tempfile.mkdtemp(prefix='rft-startup-')
+    try:
+        write_rft_history(os.path.join(workdir, 'RFT 2024.csv'), args.rows)
+        snapshot_dir = os.path.join(workdir, 'rft_snapshot')
+
+        # worker ไม่สร้าง snapshot เอง ทุกรอบจึงอ่าน CSV
+        cold_seconds, cold_memory = start_worker(workdir, args.repeat)
+
+        build_timings = []
+        for _ in range(args.repeat):
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            seconds, _ = run([sys.executable, os.path.join(REPO_DIR, 'main.py'), 'build-snapshot'], workdir)
+            build_timings.append(seconds)
+
+        warm_seconds, warm_memory = start_worker(workdir, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"rows:                     {args.rows:,}")
+    print(f"startup without snapshot: {cold_seconds:.3f}s  (RssAnon {cold_memory['rss_anon_mb']} MB, "
+          f"RssFile {cold_memory['rss_file_mb']} MB, peak {cold_memory['peak_rss_mb']} MB)")
+    print(f"build-snapshot:           {min(build_timings):.3f}s")
+    print(f"startup with snapshot:    {warm_seconds:.3f}s  (RssAnon {warm_memory['rss_anon_mb']} MB, "
+          f"RssFile {warm_memory['rss_file_mb']} MB, peak {warm_memory['peak_rss_mb']} MB)")
+    print(f"speedup:                  {cold_seconds / warm_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""สร้างข้อมูลจำลองที่มีรูปแบบเหมือน RFT 2024.csv สำหรับวัดประสิทธิภาพ"""
+import os
+
+import numpy as np
+import pandas as pd
+
+RFT_COLUMNS = ['Product', 'Batch no.', 'PO', 'Line', 'Mill', 'RFT-ext.', 'RFT-Mill', 'Dosing',
+               'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed', 'Torque',
+               'Outlet temp', 'Throughput ext.(kg/h)', 'Feed', 'Sep.', 'Rotor', 'Air flow',
+               'Inlet temp.', 'Outlet temp.', 'FG. temp.', 'Throughput mill (kg/h)']
+
+
+def product_codes(count, seed=0):
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCDEFGHJKLMNPRSTUVWXYZ'))
+    prefix = rng.choice(letters, size=(count, 2))
+    digits = rng.integers(1000, 99999, size=count)
+    suffix = rng.choice(letters, size=(count, 2))
+    codes = [f"{a}{b}{d}{c}{e}" for (a, b), d, (c, e) in zip(prefix, digits, suffix)]
+    return list(dict.fromkeys(codes))
+
+
+def generate_rft_history(rows, products=None, seed=0):
+    """คืน DataFrame ที่มีคอลัมน์และลักษณะข้อมูลเหมือน RFT 2024.csv จำนวน rows แถว"""
+    rng = np.random.default_rng(seed)
+    codes = np.array(product_codes(products or max(rows // 3, 1), seed))
+    po_numbers = rng.permutation(rows) + 100000000
+
+    def mixed(values, junk):
+        # คอลัมน์พารามิเตอร์ในข้อมูลจริงมีค่าที่ไม่ใช่ตัวเลขปนอยู่ (เช่น '50/30', '33-34')
+        values = values.astype(object)
+        positions = rng.random(rows) < 0.005
+        values[positions] = rng.choice(junk, size=positions.sum())
+        return values
+
+    data = pd.DataFrame({
+        'Product': codes[rng.integers(0, len(codes), rows)],
+        'Batch no.': [f"3B{n:08d}" for n in rng.integers(0, 10**8, rows)],
+        'PO': [f"P3B{n:09d}" for n in po_numbers],
+        'Line': rng.integers(1, 9, rows),
+        'Mill': rng.integers(1, 9, rows),
+        'RFT-ext.': np.where(rng.random(rows) < 0.45, '/', None),
+        'RFT-Mill': np.where(rng.random(rows) < 0.65, '/', None),
+        'Dosing': mixed(rng.integers(0, 3, rows).astype(str), ['O']),
+        'Suggestion Side feed': mixed(rng.integers(0, 40, rows).astype(str), ['35/12', '50/30']),
+        'HT1': rng.integers(25, 40, rows),
+        'HT2': rng.integers(45, 60, rows),
+        'HT3': rng.integers(75, 90, rows).astype(float),
+        'HT4': mixed(rng.integers(75, 90, rows).astype(str), ['8o']),
+        'HT5': rng.integers(75, 90, rows).astype(float),
+        'Screw speed': mixed((rng.integers(30, 70, rows) * 10).astype(str), ['3OO']),
+        'Torque': mixed(rng.integers(20, 60, rows).astype(str), ['33-34', '50/30']),
+        'Outlet temp': np.nan,
+        'Throughput ext.(kg/h)': rng.uniform(100, 1000, rows).round(2),
+        'Feed': mixed((rng.integers(30, 70, rows) * 10).astype(str), ['500/400']),
+        'Sep.': mixed((rng.integers(30, 150, rows) * 10).astype(str), ['45O']),
+        'Rotor': mixed((rng.integers(20, 35, rows) * 100).astype(str), ['3000/2600']),
+        'Air flow': mixed(rng.integers(50, 100, rows).astype(str), ['6O']),
+        'Inlet temp.': np.nan,
+        'Outlet temp.': np.nan,
+        'FG. temp.': np.nan,
+        'Throughput mill (kg/h)': np.where(rng.random(rows) < 0.97, rng.uniform(100, 1000, rows), np.nan),
+    }, columns=RFT_COLUMNS)
+    return data
+
+
+def write_rft_history(path, rows, **kwargs):
+    generate_rft_history(rows, **kwargs).to_csv(path, index=False, encoding='utf-8-sig')
+
+
+# คอลัมน์ของไฟล์ parameter ตามที่ /upload-parameter/ ต้องการ
+PARAMETER_COLUMNS = ['Batch no.', 'Process no.', 'Product code', 'Line', 'Mill-1', 'Extrusion (Dosing)',
+                     'Extrusion (Side feed)', 'HT1 (C)', 'HT2 (C)', 'HT3 (C)', 'HT4 (C)', 'HT5 (C)',
+                     'Screw speed (rpm)', 'Torque (%)', 'Milling-1 (Feed)', 'Milling-1 (Sep.)',
+                     'Milling-1 (Rotor)', 'Milling-1 (Air flow)']
+
+
+def upload_export_paths(directory):
+    return {name: os.path.join(directory, f"{name}.xlsx") for name in ['parameter', 'extrude', 'mill', 'qapd']}
+
+
+def write_upload_exports(directory, rows, codes, seed=0):
+    """เขียนไฟล์ Excel จำลองของ parameter, extrude, mill และ qapd ที่มี PO ตรงกัน คืน dict ของ path"""
+    rng = np.random.default_rng(seed)
+    po = [f"P3B{n:09d}" for n in rng.permutation(rows) + 900000000]
+    codes = np.asarray(codes)
+
+    parameter = pd.DataFrame({
+        'Batch no.': [f" 3B{n:08d} " for n in rng.integers(0, 10**8, rows)],
+        'Process no.': po,
+        'Product code': codes[rng.integers(0, len(codes), rows)],
+        'Line': rng.integers(1, 9, rows),
+        'Mill-1': rng.integers(1, 9, rows),
+        'Extrusion (Dosing)': rng.integers(0, 3, rows),
+        'Extrusion (Side feed)': rng.integers(0, 40, rows),
+        'HT1 (C)': rng.integers(25, 40, rows),
+        'HT2 (C)': rng.integers(45, 60, rows),
+        'HT3 (C)': rng.integers(75, 90, rows),
+        'HT4 (C)': rng.integers(75, 90, rows),
+        'HT5 (C)': rng.integers(75, 90, rows),
+        'Screw speed (rpm)': rng.integers(30, 70, rows) * 10,
+        'Torque (%)': rng.integers(20, 60, rows),
+        'Milling-1 (Feed)': rng.integers(30, 70, rows) * 10,
+        'Milling-1 (Sep.)': rng.integers(30, 150, rows) * 10,
+        'Milling-1 (Rotor)': rng.integers(20, 35, rows) * 100,
+        'Milling-1 (Air flow)': rng.integers(50, 100, rows),
+    }, columns=PARAMETER_COLUMNS)
+
+    def production_export(path):
+        # ไฟล์ extrude/mill มีหัวรายงาน 2 แถว แล้วใช้ row ที่ 3 เป็น header (มี PO ซ้ำบางส่วนจากการ re-run)
+        repeats = rng.choice(po, size=rows // 20)
+        export = pd.DataFrame({
+            'ProcessOrderId': np.concatenate([po, repeats]),
+            'ActualThroughput_AvgWeighted': rng.uniform(100, 2100, rows + len(repeats)).round(2),
+        })
+        with pd.ExcelWriter(path) as writer:
+            pd.DataFrame([['Production report'], ['']]).to_excel(writer, index=False, header=False)
+            export.to_excel(writer, index=False, startrow=2)
+
+    paths = upload_export_paths(directory)
+    parameter.to_excel(paths['parameter'], sheet_name='Sheet1', index=False)
+    production_export(paths['extrude'])
+    production_export(paths['mill'])
+
+    qapd = pd.DataFrame({
+        'Work Order no.': po,
+        'Granule': np.where(rng.random(rows) < 0.1, 'NCR', None),
+        'Defect (NCR)': np.where(rng.random(rows) < 0.1, 'NCR', None),
+    })
+    qapd.to_excel(paths['qapd'], sheet_name='Data 2023-2024', index=False)
+    return paths
@@ -0,0 +1,54 @@
+"""เซิร์ฟเวอร์จำลอง fetch_link.php ของ extruder_control สำหรับวัด /fetch_external_data/ แบบ offline
+
+ใช้งาน: python -m benchmarks.upstream_stub --port 8081 --codes 300
+แล้วตั้งค่า WIP_SOURCE_URL=http://127.0.0.1:8081/fetch_link.php
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(payload):
+    body = json.dumps(payload).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_stub(codes, host='127.0.0.1', port=0):
+    """เริ่ม server ใน thread แยก คืน (server, url)"""
+    payload = {"product": [{"code": code} for code in codes]}
+    server = ThreadingHTTPServer((host, port), make_handler(payload))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/fetch_link.php"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--codes', type=int, default=300)
+    args = parser.parse_args()
+
+    from benchmarks.synthetic import product_codes
+
+    server, url = start_stub(product_codes(args.codes), port=args.port)
+    print(f"serving {args.codes} codes at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
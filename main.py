@@ -1,32 +1,159 @@
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, BackgroundTasks, Query
 from starlette.responses import FileResponse  # นำเข้า FileResponse จาก starlette
 import pandas as pd
 import numpy as np
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import os
 import logging
-from typing import List, Dict
-from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Dict, Optional
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 import uuid  # ใช้ UUID
 import json  # ใช้สำหรับแปลงสตริงเป็น JSON
+import orjson
 import httpx
+import asyncio
+import threading
+import time
+import pickle
+import weakref
+import hashlib
+from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import fcntl
+except ImportError:
+    # Windows ไม่มี fcntl ใช้ msvcrt ล็อกไฟล์แทน
+    fcntl = None
+    import msvcrt
 
 app = FastAPI()
 
-# สร้าง dict เพื่อเก็บข้อมูลชั่วคราว
-uploaded_files_data = {
-    'parameter': None,
-    'extrude': None,
-    'mill': None,
-    'qapd': None,
-    "combined": None
-}
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-# ตั้งค่า Logging เพื่อช่วย Debug
-logging.basicConfig(level=logging.DEBUG)
+def write_pickle_atomic(path, value):
+    # เขียนลงไฟล์ชั่วคราวแล้วแทนที่ เพื่อไม่ให้ worker อื่นอ่านไฟล์ที่เขียนไม่เสร็จ
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class SharedStaging:
+    """ที่เก็บข้อมูลชั่วคราวแบบ dict แต่บันทึก DataFrame ไว้บนดิสก์ เพื่อให้ทุก worker เห็นข้อมูลชุดเดียวกัน"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def __getitem__(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def __setitem__(self, key, value):
+        if value is None:
+            if key in self:
+                os.remove(self._path(key))
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        write_pickle_atomic(self._path(key), value)
+
+class UploadCache:
+    """cache ผลการ clean ไฟล์ Excel บนดิสก์ โดยใช้ hash ของเนื้อไฟล์เป็น key และลบไฟล์ที่ใช้ล่าสุดนานที่สุดเมื่อเกินขนาด"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key):
+        if self.max_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Discarding unreadable upload cache entry %s: %s", key, e)
+            self._remove(path)
+            return None
+        # ใช้ mtime เป็นเวลาที่ใช้ล่าสุด (ทุก worker เห็นค่าเดียวกัน)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        if self.max_bytes <= 0:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_pickle_atomic(self._path(key), value)
+            self._evict()
+        except OSError as e:
+            logging.warning("Could not write upload cache entry %s: %s", key, e)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# เก็บข้อมูลชั่วคราว (parameter, extrude, mill, qapd, combined_data)
+uploaded_files_data = SharedStaging(os.environ.get('UPLOAD_STAGING_DIR', 'upload_staging'))
+
+# cache ผลการ clean ไฟล์ที่อัปโหลด (อัปโหลดไฟล์เดิมซ้ำจะไม่ต้องอ่าน Excel ใหม่)
+upload_cache = UploadCache(
+    os.environ.get('UPLOAD_CACHE_DIR', 'upload_cache'),
+    int(os.environ.get('UPLOAD_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+)
+
+# ตั้งค่า Logging (ตั้ง LOG_LEVEL=DEBUG เพื่อเปิดการ Debug)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 app = FastAPI()
 app.add_middleware(
@@ -37,138 +164,1716 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ตัวเก็บค่า metrics แบบ Prometheus (histogram และ counter) ของ worker นี้
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "rft_stage_duration_seconds": ("histogram", "Time spent in each processing stage"),
+    "rft_rank_outcomes_total": ("counter", "Ranking results by outcome"),
+    "rft_upload_cache_total": ("counter", "Upload cache lookups by result"),
+}
+metrics_lock = threading.Lock()
+metric_histograms = {}
+metric_counters = {}
+
+def observe(name, labels, seconds):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        buckets = metric_histograms.get(key)
+        if buckets is None:
+            # จำนวนต่อ bucket + sum + count
+            buckets = metric_histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        buckets[-2] += seconds
+        buckets[-1] += 1
+
+def increment(name, labels, amount=1):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + amount
+
+# ผลการจัดอันดับที่นับระหว่าง compute() ถูกเก็บไว้คู่กับผลลัพธ์ใน cache เพื่อนับซ้ำเมื่อตอบจาก cache หรือ 304
+outcome_recorder = threading.local()
+
+def count_outcome(endpoint, outcome, amount=1):
+    increment("rft_rank_outcomes_total", {"endpoint": endpoint, "outcome": outcome}, amount)
+    recorded = getattr(outcome_recorder, "outcomes", None)
+    if recorded is not None:
+        recorded.append((endpoint, outcome, amount))
+
+def record_outcomes(compute):
+    """เรียก compute() แล้วคืน (ผลลัพธ์, รายการ outcome ที่นับระหว่างนั้น)"""
+    previous = getattr(outcome_recorder, "outcomes", None)
+    outcome_recorder.outcomes = []
+    try:
+        result = compute()
+        return result, outcome_recorder.outcomes
+    finally:
+        outcome_recorder.outcomes = previous
+
+def replay_outcomes(outcomes):
+    for endpoint, outcome, amount in outcomes:
+        count_outcome(endpoint, outcome, amount)
+
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("rft_stage_duration_seconds", {"stage": stage}, time.perf_counter() - start)
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+def render_metrics():
+    """แปลง metrics ทั้งหมดเป็นข้อความตามรูปแบบ Prometheus"""
+    with metrics_lock:
+        histograms = {key: list(values) for key, values in metric_histograms.items()}
+        counters = dict(metric_counters)
+
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, values):
+                    lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {values[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-2]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        else:
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # ใช้ path ของ route (เช่น /download-json/{json_id}) เพื่อไม่ให้ label มีจำนวนไม่จำกัด
+    route = request.scope.get("route")
+    observe(
+        "http_request_duration_seconds",
+        {"method": request.method, "route": route.path if route is not None else "unmatched", "status": response.status_code},
+        time.perf_counter() - start,
+    )
+    return response
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
 # โหลดไฟล์ CSV และอ่าน
-file_path = 'RFT 2024.csv'  
+file_path = os.environ.get('RFT_DATA_FILE', 'RFT 2024.csv')
 if not os.path.exists(file_path):
     raise FileNotFoundError(f"CSV file not found: {file_path}")
 
-try:
-    df = pd.read_csv(file_path)  
-except Exception as e:
-    raise Exception(f"Error loading CSV file: {e}")
-
-# แปลงคอลัมน์ Throughput mill (kg/h) เป็นตัวเลข ถ้ามีปัญหาจะใช้ NaN แทน
-df['Throughput mill (kg/h)'] = pd.to_numeric(df['Throughput mill (kg/h)'], errors='coerce')
-
-class ProductRequest(BaseModel):
-    product_name: str
+# ข้อมูลที่ append เข้ามาใหม่จะถูกเขียนเป็นไฟล์ segment แยก แล้วค่อยรวม (compact) เข้า RFT 2024.csv ภายหลัง
+segment_dir = os.environ.get('RFT_SEGMENT_DIR', 'rft_segments')
+max_segments = int(os.environ.get('RFT_MAX_SEGMENTS', '20'))
+
+# ล็อกสำหรับการเขียน segment และการ compact ไม่ให้ทำงานชนกัน ทั้งระหว่าง thread และระหว่าง worker (uvicorn --workers N)
+storage_thread_lock = threading.RLock()
+storage_lock_path = os.environ.get('RFT_LOCK_FILE', 'rft_storage.lock')
+
+# เลข generation ของข้อมูลที่ใช้ร่วมกันทุก worker จะเพิ่มขึ้นทุกครั้งที่ append หรือ compact
+generation_path = os.environ.get('RFT_GENERATION_FILE', 'rft_generation')
+
+def lock_file_exclusive(lock_file, blocking=True):
+    """ล็อกไฟล์แบบ exclusive คืน False ถ้า blocking=False และมี process อื่นถือล็อกอยู่"""
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    # msvcrt.locking ล็อกเป็นช่วง byte และเลิกรอเมื่อครบ 10 วินาที จึงต้องวนรอเอง
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+
+def unlock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def storage_lock(blocking=True):
+    """ถือล็อกของข้อมูลบนดิสก์ ถ้า blocking=False จะไม่รอ และ yield False เมื่อมีผู้อื่นถือล็อกอยู่"""
+    if not storage_thread_lock.acquire(blocking=blocking):
+        yield False
+        return
+    try:
+        with open(storage_lock_path, 'a') as lock_file:
+            if not lock_file_exclusive(lock_file, blocking):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                unlock_file(lock_file)
+    finally:
+        storage_thread_lock.release()
 
-@app.post("/rank_product/")
-def rank_product(request: ProductRequest):
-    product_name = request.product_name.upper()  # เปลี่ยนเป็น Upercase ให้หมดก่อนนำไปหา
+def read_generation():
+    try:
+        with open(generation_path) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+def bump_generation():
+    # ต้องเรียกขณะถือ storage_lock
+    generation = read_generation() + 1
+    with open(f"{generation_path}.tmp", 'w') as f:
+        f.write(str(generation))
+    os.replace(f"{generation_path}.tmp", generation_path)
+    return generation
+
+def list_segments():
+    """คืนรายชื่อไฟล์ segment เรียงตามลำดับที่ append (ไม่รวม segment ที่ถูกรวมเข้า RFT 2024.csv แล้ว)"""
+    if not os.path.isdir(segment_dir):
+        return []
+    folded = folded_segments()
+    return sorted(os.path.join(segment_dir, name) for name in os.listdir(segment_dir)
+                  if name.endswith('.csv') and name not in folded)
+
+# dtype ของแต่ละคอลัมน์ใน df (ใช้ทั้งตอนโหลดและตอน append)
+# 'flag' คือคอลัมน์ RFT ที่เก็บเป็น bool (True เมื่อมีค่า '/')
+RFT_SCHEMA = {
+    'Product': 'category',
+    'Batch no.': 'object',
+    'PO': 'object',
+    'Line': 'float32',
+    'Mill': 'float32',
+    'RFT-ext.': 'flag',
+    'RFT-Mill': 'flag',
+    'Dosing': 'float32',
+    'Suggestion Side feed': 'float32',
+    'HT1': 'float32',
+    'HT2': 'float32',
+    'HT3': 'float32',
+    'HT4': 'float32',
+    'HT5': 'float32',
+    'Screw speed': 'float32',
+    'Torque': 'float32',
+    'Outlet temp': 'float32',
+    'Throughput ext.(kg/h)': 'float64',
+    'Feed': 'float32',
+    'Sep.': 'float32',
+    'Rotor': 'float32',
+    'Air flow': 'float32',
+    'Inlet temp.': 'float32',
+    'Outlet temp.': 'float32',
+    'FG. temp.': 'float32',
+    'Throughput mill (kg/h)': 'float64',
+}
 
-    logging.debug(f"Received product name: {product_name}")
+# คอลัมน์พารามิเตอร์ที่อาจมีค่าที่ไม่ใช่ตัวเลข (เช่น '50/30', '33-34') ซึ่งต้องส่งกลับตามเดิม
+# ถ้าพบค่าแบบนี้จะเก็บทั้งคอลัมน์เป็น category แทนการแปลงเป็น NaN
+TEXT_FALLBACK_COLUMNS = ['Dosing', 'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5',
+                         'Screw speed', 'Torque', 'Feed', 'Sep.', 'Rotor', 'Air flow']
+
+def as_text_category(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values
+    text = values.astype(str)
+    if pd.api.types.is_numeric_dtype(values):
+        # ตัวเลขจำนวนเต็มให้เป็นข้อความแบบเดียวกับใน CSV (เช่น '38' แทน '38.0')
+        whole = values.notna() & (values % 1 == 0)
+        text[whole] = values[whole].astype('int64').astype(str)
+    return text.where(values.notna()).astype('category')
+
+def apply_schema(data):
+    """แปลง dtype ของแต่ละคอลัมน์ตาม RFT_SCHEMA (คอลัมน์ที่มี dtype ถูกต้องอยู่แล้วจะไม่ถูกแปลงซ้ำ)"""
+    for col, dtype in RFT_SCHEMA.items():
+        if col not in data.columns:
+            continue
+        values = data[col]
+
+        if dtype == 'flag':
+            if values.dtype != bool:
+                data[col] = values.isin(['/', True])
+        elif dtype == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                data[col] = values.astype('category')
+        elif dtype != 'object':
+            if values.dtype == dtype or (col in TEXT_FALLBACK_COLUMNS and isinstance(values.dtype, pd.CategoricalDtype)):
+                continue
+            # แปลงเป็นตัวเลข ถ้ามีปัญหาจะใช้ NaN แทน
+            numeric = pd.to_numeric(values, errors='coerce')
+            if col in TEXT_FALLBACK_COLUMNS and (numeric.isna() & values.notna()).any():
+                data[col] = as_text_category(values)
+            else:
+                data[col] = numeric.astype(dtype)
+    return data
 
-    if product_name not in df['Product'].str.upper().values:
-        raise HTTPException(status_code=404, detail=f"No data found for product: {product_name}")
+def prepare_rft_frame(data):
+    return apply_schema(data)
 
-    product_df = df[df['Product'].str.upper() == product_name].copy()
+def concat_rft_frames(frames):
+    """ต่อ DataFrame หลายชุดโดยคง dtype ตาม RFT_SCHEMA ไว้"""
+    frames = [apply_schema(frame.copy()) for frame in frames]
 
-    if product_df.empty:
-        raise HTTPException(status_code=404, detail=f"No data found for product: {product_name}")
+    # คอลัมน์ category ต้องมีรายการ categories เดียวกันทุกชุด ไม่เช่นนั้น concat จะได้ object
+    columns = dict.fromkeys(col for frame in frames for col in frame.columns)
+    for col in columns:
+        present = [frame for frame in frames if col in frame.columns]
+        if not any(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in present):
+            continue
+        for frame in present:
+            frame[col] = as_text_category(frame[col])
+        categories = present[0][col].cat.categories
+        for frame in present[1:]:
+            categories = categories.union(frame[col].cat.categories, sort=False)
+        for frame in frames:
+            if col in frame.columns:
+                frame[col] = frame[col].cat.set_categories(categories)
+            else:
+                frame[col] = pd.Categorical([None] * len(frame), categories=categories)
+
+    data = pd.concat(frames, ignore_index=True)
+    return apply_schema(data)
+
+# รวมชุดข้อมูลที่ append เข้ามาเป็นชุดเดียวเมื่อมีจำนวนเกินกำหนด
+RFT_MAX_CHUNKS = int(os.environ.get('RFT_MAX_CHUNKS', '8'))
+
+class TextColumn:
+    """คอลัมน์ข้อความของ snapshot: รหัส int32 ต่อแถว (-1 คือค่าว่าง) + รายการค่าที่ไม่ซ้ำ ทั้งสองชี้ไปที่ไฟล์ที่ map ไว้
+
+    แปลงเป็น str เฉพาะแถวที่ต้องใช้ (ไม่สร้าง object ของทุกแถวในหน่วยความจำของแต่ละ worker)
+    """
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.categories.nbytes
+
+    def take(self, positions):
+        codes = self.codes[positions]
+        if not len(self.categories):
+            return np.full(len(codes), np.nan, dtype=object)
+        values = self.categories[np.maximum(codes, 0)].astype(object)
+        values[codes < 0] = np.nan
+        return values
+
+class RftData:
+    """ข้อมูล RFT ทั้งหมด: ส่วนหลัก (RFT 2024.csv จาก snapshot) + ชุดข้อมูลที่ append เข้ามาแต่ละครั้ง
+
+    label ของแถวคือตำแหน่งในข้อมูลทั้งหมด (index ของแต่ละชุดต่อเนื่องกัน) append คืน RftData ใหม่
+    ที่ใช้ frame เดิมร่วมกัน จึงไม่ต้องคัดลอกส่วนหลัก และคอลัมน์ตัวเลขของส่วนหลักยังชี้ไปที่ snapshot ที่ map ไว้
+    text: คอลัมน์ข้อความของส่วนหลักที่เก็บแยกจาก DataFrame (TextColumn), base_columns: ลำดับคอลัมน์ของส่วนหลัก
+    base_indexes: index ของส่วนหลักที่โหลดจาก snapshot (None ถ้าต้องสร้างเอง)
+    """
+
+    def __init__(self, chunks, text=None, base_columns=None, base_indexes=None):
+        self.chunks = chunks
+        self.text = text or {}
+        self.base_columns = base_columns or list(chunks[0].columns)
+        self.base_indexes = base_indexes
+        self.starts = np.cumsum([0] + [len(chunk) for chunk in chunks])
+        self.columns = list(dict.fromkeys(self.base_columns + [col for chunk in chunks[1:] for col in chunk.columns]))
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def append(self, data):
+        """เพิ่มข้อมูลชุดใหม่ (แปลง dtype เฉพาะชุดใหม่) คืน (RftData ใหม่, แถวที่เพิ่มเข้ามาพร้อม label)"""
+        batch = prepare_rft_frame(data.copy())
+        batch.index = pd.RangeIndex(len(self), len(self) + len(batch))
+        chunks = self.chunks + [batch]
+        if len(chunks) > RFT_MAX_CHUNKS:
+            # รวมเฉพาะชุดที่ append เข้ามา ไม่แตะส่วนหลัก
+            merged = concat_rft_frames(chunks[1:])
+            merged.index = pd.RangeIndex(len(chunks[0]), len(chunks[0]) + len(merged))
+            chunks = [chunks[0], merged]
+        return RftData(chunks, self.text, self.base_columns, self.base_indexes), batch
+
+    def locate(self, labels):
+        # ชุดข้อมูลของแต่ละ label
+        return np.searchsorted(self.starts, labels, side='right') - 1
+
+    def take(self, col, labels):
+        """ค่าของคอลัมน์ตัวเลข col ที่ label ที่ระบุ (เรียงตาม labels)"""
+        labels = np.asarray(labels, dtype=np.int64)
+        if len(self.chunks) == 1:
+            return self.chunks[0][col].to_numpy()[labels]
+        values = np.full(len(labels), np.nan)
+        chunk_ids = self.locate(labels)
+        for i in np.unique(chunk_ids):
+            chunk = self.chunks[i]
+            if col in chunk.columns:
+                picked = chunk_ids == i
+                values[picked] = chunk[col].to_numpy()[labels[picked] - self.starts[i]]
+        return values
+
+    def chunk_rows(self, i, labels, columns):
+        chunk = self.chunks[i]
+        # เลือกแถวก่อนแล้วค่อยเลือกคอลัมน์ (.loc[labels, columns] คัดลอกทั้งคอลัมน์ก่อนเลือกแถว)
+        rows = chunk.iloc[labels - self.starts[i]][[col for col in columns if col in chunk.columns]]
+        if i == 0 and self.text:
+            # label ของส่วนหลักคือตำแหน่งแถวใน TextColumn
+            rows = rows.assign(**{col: self.text[col].take(labels) for col in columns if col in self.text})
+        return rows
+
+    def rows(self, labels, columns):
+        """DataFrame ของแถวที่ label ที่ระบุ (เรียงตาม labels) เฉพาะคอลัมน์ columns"""
+        labels = np.asarray(labels, dtype=np.int64)
+        chunk_ids = self.locate(labels)
+        parts = [self.chunk_rows(i, labels[chunk_ids == i], columns) for i in np.unique(chunk_ids)]
+        if not parts:
+            return self.chunk_rows(0, labels, columns).reindex(columns=columns)
+        if len(parts) > 1:
+            # คอลัมน์ที่ chunk หนึ่งเก็บเป็นข้อความ ให้ chunk อื่นเป็นข้อความด้วย (เหมือนหลังรวมเป็นไฟล์เดียว)
+            text = {col for part in parts for col in part.columns if isinstance(part[col].dtype, pd.CategoricalDtype)}
+            parts = [part.assign(**{col: as_text_category(part[col]) for col in text & set(part.columns)}) for part in parts]
+        rows = parts[0] if len(parts) == 1 else pd.concat([part.astype(object) for part in parts])
+        return rows.reindex(index=labels, columns=columns)
+
+    def record(self, label, columns):
+        """แถวเดียวเป็น dict (ค่าเป็นชนิดของ Python เหมือน to_dict('records')) โดยไม่ต้องสร้าง DataFrame"""
+        i = int(self.locate(label))
+        chunk, position = self.chunks[i], int(label - self.starts[i])
+        entry = {}
+        for col in columns:
+            if i == 0 and col in self.text:
+                value = self.text[col].take([position])[0]
+            else:
+                value = chunk[col].iat[position] if col in chunk.columns else np.nan
+            entry[col] = value.item() if isinstance(value, np.generic) else value
+        return entry
+
+    def base_frame(self):
+        """ส่วนหลักเป็น DataFrame ที่มีทุกคอลัมน์ (แปลงคอลัมน์ข้อความทั้งคอลัมน์)"""
+        base = self.chunks[0]
+        if not self.text:
+            return base
+        return base.assign(**{col: column.take(slice(None)) for col, column in self.text.items()})[self.base_columns]
+
+    def frame(self):
+        """รวมทุกชุดเป็น DataFrame เดียว (ใช้ตอน compact)"""
+        return self.base_frame() if len(self.chunks) == 1 else concat_rft_frames([self.base_frame()] + self.chunks[1:])
+
+def csv_number_column(values):
+    """คอลัมน์ตัวเลขสำหรับเขียน CSV: ค่าที่เป็นจำนวนเต็มเขียนแบบไม่มี .0 เหมือนไฟล์ต้นฉบับ"""
+    numbers = values.to_numpy()
+    if numbers.dtype == np.float32:
+        # แปลงผ่าน str เพื่อให้ได้ทศนิยมตามที่บันทึกไว้ (เช่น 613.33 แทน 613.3300170898438)
+        numbers = numbers.astype(str).astype(np.float64)
+    whole = np.isfinite(numbers) & (numbers == np.round(numbers))
+    if not whole.any():
+        return pd.Series(numbers, index=values.index)
+    if whole.sum() == (~np.isnan(numbers)).sum():
+        return pd.Series(numbers, index=values.index).astype('Int64')
+    mixed = pd.Series(numbers, index=values.index, dtype=object)
+    mixed[whole] = numbers[whole].astype(np.int64)
+    return mixed
+
+def to_csv_frame(data):
+    """แปลง df กลับเป็นรูปแบบเดียวกับ RFT 2024.csv ก่อนบันทึกไฟล์"""
+    data = data.copy()
+    for col, dtype in RFT_SCHEMA.items():
+        if dtype == 'flag' and col in data.columns:
+            data[col] = np.where(data[col], '/', '')
+    for col in data.columns:
+        if data[col].dtype.kind == 'f':
+            data[col] = csv_number_column(data[col])
+    return data
+
+# snapshot แบบ binary (ไฟล์ .npy ต่อคอลัมน์) ของ RFT 2024.csv เพื่อให้เริ่มต้น server ได้เร็วโดยไม่ต้อง parse CSV
+snapshot_dir = os.environ.get('RFT_SNAPSHOT_DIR', 'rft_snapshot')
+SNAPSHOT_VERSION = 3
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def write_snapshot_files(data, source_path=None, folded=()):
+    """เขียนไฟล์ .npy ของ snapshot คืน schema ที่ยังไม่ถูกใช้งานจนกว่าจะเรียก publish_snapshot
+
+    folded: ชื่อ segment ที่รวมอยู่ใน source_path แล้ว (ใช้ข้าม segment ที่ค้างอยู่ถ้า process หยุดระหว่าง compact)
+    """
+    source_path = source_path or file_path
+    os.makedirs(snapshot_dir, exist_ok=True)
+    token = uuid.uuid4().hex[:8]
+    columns = []
+
+    for i, col in enumerate(data.columns):
+        values = data[col]
+        entry = {"name": col, "data": f"{token}-{i}.npy"}
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # category เก็บรหัสและรายการ categories ตามที่อยู่ในหน่วยความจำ
+            entry["dtype"] = "category"
+            entry["categories"] = f"{token}-{i}.categories.npy"
+            np.save(os.path.join(snapshot_dir, entry["categories"]), np.asarray(values.cat.categories, dtype=str))
+            array = values.cat.codes.to_numpy().astype(np.int32)
+        elif pd.api.types.is_numeric_dtype(values):
+            entry["dtype"] = str(values.dtype)
+            array = values.to_numpy()
+        else:
+            # คอลัมน์ข้อความเก็บแบบ dictionary: รหัส int32 ต่อแถว (-1 คือค่าว่าง) + รายการค่าที่ไม่ซ้ำ
+            entry["dtype"] = "str"
+            entry["categories"] = f"{token}-{i}.categories.npy"
+            codes, uniques = pd.factorize(values.astype(str).where(values.notna()))
+            np.save(os.path.join(snapshot_dir, entry["categories"]), np.asarray(uniques, dtype=str))
+            array = codes.astype(np.int32)
+        np.save(os.path.join(snapshot_dir, entry["data"]), array)
+        columns.append(entry)
+
+    # index ของส่วนหลัก worker ทุกตัว map ไฟล์เดียวกันแทนการสร้างเองตอนเริ่มต้น
+    indexes = {}
+    for kind, arrays in snapshot_indexes(data).items():
+        indexes[kind] = {}
+        for name, array in arrays.items():
+            indexes[kind][name] = f"{token}-{kind}-{name}.npy"
+            np.save(os.path.join(snapshot_dir, indexes[kind][name]), array)
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "source": source_fingerprint(source_path),
+        "rows": len(data),
+        "columns": columns,
+        "indexes": indexes,
+        "segments": sorted(folded),
+    }
 
-    result = {"extrude": {}, "mill": {}}
+def snapshot_files(schema):
+    """ชื่อไฟล์ .npy ทั้งหมดที่ schema ใช้"""
+    files = {entry[key] for entry in schema["columns"] for key in ("data", "categories") if key in entry}
+    return files | {name for arrays in schema.get("indexes", {}).values() for name in arrays.values()}
 
-    # มีค่า / ใน Column RFT-ext. และ RFT-Mill
-    filtered_df = product_df[(product_df['RFT-ext.'] == '/') & (product_df['RFT-Mill'] == '/')].copy()
+def publish_snapshot(schema):
+    """ใช้ snapshot ที่เขียนไว้: แทนที่ schema.json แบบ atomic แล้วค่อยลบไฟล์ของ snapshot เก่า"""
+    schema_path = os.path.join(snapshot_dir, 'schema.json')
+    with open(f"{schema_path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(schema, f, ensure_ascii=False)
+    os.replace(f"{schema_path}.tmp", schema_path)
 
-    logging.debug(f"Filtered DataFrame: {filtered_df}")
+    used = snapshot_files(schema)
+    for name in os.listdir(snapshot_dir):
+        if name.endswith('.npy') and name not in used:
+            remove_file(os.path.join(snapshot_dir, name))
 
-    if filtered_df.empty:
-        raise HTTPException(status_code=404, detail="No matching data found for both RFT-ext. and RFT-Mill.")
+def discard_snapshot_files(schema):
+    for name in snapshot_files(schema):
+        remove_file(os.path.join(snapshot_dir, name))
 
-    filtered_df = filtered_df.dropna(subset=['Throughput mill (kg/h)'])
+def read_snapshot_schema():
+    try:
+        with open(os.path.join(snapshot_dir, 'schema.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def folded_segments():
+    """ชื่อ segment ที่ snapshot ปัจจุบันบันทึกว่ารวมเข้า RFT 2024.csv แล้ว (ใช้ได้เมื่อ snapshot ตรงกับไฟล์เท่านั้น)"""
+    schema = read_snapshot_schema()
+    try:
+        if schema is None or schema.get("source") != source_fingerprint(file_path):
+            return set()
+    except FileNotFoundError:
+        return set()
+    return set(schema.get("segments", []))
+
+def load_snapshot_array(name):
+    # map ไฟล์แบบอ่านอย่างเดียว worker ทุกตัวใช้หน้าหน่วยความจำ (page cache) ชุดเดียวกัน
+    return np.asarray(np.load(os.path.join(snapshot_dir, name), mmap_mode='r', allow_pickle=False))
+
+def current_snapshot_schema(source_path=None):
+    """schema ของ snapshot ถ้ายังตรงกับ RFT 2024.csv ปัจจุบัน ถ้าไม่มีหรือล้าสมัยจะคืน None"""
+    schema = read_snapshot_schema()
+    try:
+        if schema is None or schema.get("version") != SNAPSHOT_VERSION or schema.get("source") != source_fingerprint(source_path or file_path):
+            return None
+    except FileNotFoundError:
+        return None
+    return schema
+
+def load_snapshot(source_path=None):
+    """โหลด snapshot ถ้ายังตรงกับ RFT 2024.csv ปัจจุบัน คืน RftData ของส่วนหลัก ถ้าไม่มีหรือล้าสมัยจะคืน None"""
+    schema = current_snapshot_schema(source_path)
+    if schema is None:
+        return None
 
-    if filtered_df.empty:
-        return {"warning": "No valid numerical data found in 'Throughput mill (kg/h)' column. Skipping throughput ranking."}
+    try:
+        data, text = {}, {}
+        for entry in schema["columns"]:
+            array = load_snapshot_array(entry["data"])
+            if entry["dtype"] == "str":
+                # ไม่แปลงเป็น object ทั้งคอลัมน์ เก็บรหัสกับรายการค่าที่ map ไว้ แล้วแปลงเฉพาะแถวที่ต้องใช้
+                text[entry["name"]] = TextColumn(array, load_snapshot_array(entry["categories"]))
+            elif entry["dtype"] == "category":
+                categories = np.load(os.path.join(snapshot_dir, entry["categories"]), allow_pickle=False)
+                data[entry["name"]] = pd.Categorical.from_codes(array, categories=categories.astype(object))
+            else:
+                data[entry["name"]] = np.asarray(array, dtype=entry["dtype"])
+        # copy=False ให้คอลัมน์ตัวเลขยังชี้ไปที่ไฟล์ที่ map ไว้ worker ทุกตัวจึงใช้หน่วยความจำ (page cache) ชุดเดียวกัน
+        base = pd.DataFrame(data, columns=list(data), copy=False)
+        indexes = {kind: {name: load_snapshot_array(path) for name, path in arrays.items()}
+                   for kind, arrays in schema.get("indexes", {}).items()}
+        return RftData([base], text, [entry["name"] for entry in schema["columns"]], indexes or None)
+    except Exception as e:
+        logging.warning(f"Error loading RFT snapshot, falling back to CSV: {e}")
+        return None
+
+def load_base_data():
+    """โหลด RFT 2024.csv (คืน RftData) จาก snapshot ถ้าใช้ได้ ไม่เช่นนั้นอ่านจาก CSV
+
+    worker ไม่เขียน snapshot เอง (สร้างด้วย python main.py build-snapshot ก่อนเริ่ม server หรือตอน compact)
+    """
+    data = load_snapshot()
+    if data is not None:
+        return data
+
+    logging.warning("RFT snapshot is missing or stale, loading %s from CSV (run: python main.py build-snapshot)", file_path)
+    return RftData([prepare_rft_frame(pd.read_csv(file_path))])
+
+def build_snapshot():
+    """สร้าง snapshot ของ RFT 2024.csv ถ้ายังไม่มีหรือล้าสมัย (ขั้นตอน build/release ก่อนเริ่ม server) คืน True ถ้าสร้างใหม่
+
+    อ่าน CSV และเขียนไฟล์โดยไม่ถือ storage_lock ถือล็อกเฉพาะตอนใช้งาน snapshot (ข้ามถ้าไฟล์ถูก compact ระหว่างนั้น)
+    """
+    if current_snapshot_schema() is not None:
+        return False
+    base = source_fingerprint(file_path)
+    schema = write_snapshot_files(prepare_rft_frame(pd.read_csv(file_path)))
+    with storage_lock():
+        if source_fingerprint(file_path) != base or current_snapshot_schema() is not None:
+            discard_snapshot_files(schema)
+            return False
+        publish_snapshot(schema)
+    return True
+
+def load_rft_data(segments=None):
+    """อ่าน RFT 2024.csv และ segment ทั้งหมดที่ยังไม่ได้ compact"""
+    segments = list_segments() if segments is None else segments
+    data = load_base_data()
+    for path in segments:
+        data, _ = data.append(pd.read_csv(path))
+    return data
+
+# สถานะของข้อมูลที่ worker นี้โหลดไว้ ใช้เทียบกับ generation บนดิสก์
+loaded_state = {"generation": None, "base": None, "segments": set(), "tag": None}
+
+def set_loaded_state(**changes):
+    """อัปเดตสถานะข้อมูลที่โหลดไว้ และคำนวณ tag ของข้อมูลชุดนี้ใหม่ (ใช้เป็น ETag และ key ของ cache)"""
+    loaded_state.update(changes)
+    # รวม fingerprint ของ RFT 2024.csv ด้วย เพราะไฟล์ generation อาจถูกรีเซ็ตเมื่อ deploy ใหม่
+    version = f"{loaded_state['generation']}:{loaded_state['base']['size']}:{loaded_state['base']['mtime_ns']}"
+    loaded_state["tag"] = hashlib.sha1(version.encode()).hexdigest()[:16]
+
+# คอลัมน์ที่ endpoint ranking ต้องใช้จากแถวที่ดีที่สุดของแต่ละ Product
+BEST_RUN_COLUMNS = ['Product', 'PO', 'Line', 'Mill', 'Dosing', 'Suggestion Side feed',
+                    'HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed', 'Torque',
+                    'Throughput ext.(kg/h)', 'Feed', 'Sep.', 'Rotor', 'Air flow',
+                    'Throughput mill (kg/h)']
+
+def product_ids(values):
+    """รหัส Product ตัวพิมพ์ใหญ่ที่เรียงแล้ว และตำแหน่งของรหัสของแต่ละแถว (-1 ถ้าไม่มีค่า)
+
+    แปลงเป็นตัวพิมพ์ใหญ่เฉพาะ category แล้วใช้ code ของ category แทนการเทียบ string ทุกแถว
+    """
+    categories = pd.Categorical(values)
+    category_ids, names = pd.factorize(np.asarray(categories.categories.astype(str).str.upper(), dtype=object), sort=True)
+    ids = np.where(categories.codes >= 0, category_ids[categories.codes], -1)
+    return names, ids
+
+class BestRunIndex:
+    """แถวที่ผ่าน RFT ของแต่ละ Product เรียงตาม Throughput mill จากมากไปน้อย เก็บเป็น array แบบ CSR (ไม่มี object ต่อ Product)
+
+    codes: รหัส Product (ตัวพิมพ์ใหญ่) ที่เรียงแล้ว, rft[i]: codes[i] มีแถวที่ผ่าน RFT
+    labels[offsets[i]:offsets[i + 1]]: label ของแถวที่ผ่าน RFT และมี Throughput ของ codes[i] (แถวแรกคือแถวที่ดีที่สุด)
+    Product ที่มีข้อมูลใหม่หลังสร้าง index เก็บใน updates (code -> (rft, labels)) ไม่แก้ไข array เดิม
+    """
+
+    def __init__(self, codes, rft, offsets, labels, updates=None):
+        self.codes = codes
+        self.rft = rft
+        self.offsets = offsets
+        self.labels = labels
+        self.updates = updates or {}
+
+    @classmethod
+    def from_frame(cls, data):
+        names, ids = product_ids(data['Product'])
+        present = ids >= 0
+        codes = np.asarray(names, dtype=str)
+
+        rft_passed = (data['RFT-ext.'] & data['RFT-Mill']).to_numpy() & present
+        rft = np.bincount(ids[rft_passed], minlength=len(codes)) > 0
+
+        # idxmax ต่อ Product แทนการ sort ทั้งตารางทุกครั้งที่มี request: เรียงตาม (Product, Throughput จากมากไปน้อย)
+        # lexsort เป็น stable sort ถ้า Throughput เท่ากันแถวที่มาก่อนจะอยู่ก่อน (เหมือน idxmax ที่เลือกแถวแรก)
+        throughput = data['Throughput mill (kg/h)'].to_numpy(dtype=np.float64)
+        rows = np.flatnonzero(rft_passed & ~np.isnan(throughput))
+        rows = rows[np.lexsort((-throughput[rows], ids[rows]))]
+        offsets = np.r_[0, np.cumsum(np.bincount(ids[rows], minlength=len(codes)))].astype(np.int64)
+        labels = data.index.to_numpy()[rows].astype(np.int64)
+        return cls(codes, rft, offsets, labels)
+
+    def to_arrays(self):
+        """array ของ index (ไม่รวม updates) สำหรับบันทึกลง snapshot"""
+        return {"codes": self.codes, "rft": self.rft, "offsets": self.offsets, "labels": self.labels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["codes"], arrays["rft"], arrays["offsets"], arrays["labels"])
+
+    def entry(self, code):
+        """(ผ่าน RFT หรือไม่, labels ที่เรียงแล้ว) ของ Product หรือ None ถ้าไม่มีข้อมูล"""
+        update = self.updates.get(code)
+        if update is not None:
+            return update
+        i = int(np.searchsorted(self.codes, code))
+        if i < len(self.codes) and self.codes[i] == code:
+            return bool(self.rft[i]), self.labels[self.offsets[i]:self.offsets[i + 1]]
+        return None
+
+    def outcome(self, code):
+        """สถานะของ Product: no_data, no_rft, no_throughput หรือ ok"""
+        entry = self.entry(code)
+        if entry is None:
+            return "no_data"
+        if not entry[0]:
+            return "no_rft"
+        if not len(entry[1]):
+            return "no_throughput"
+        return "ok"
+
+    def runs(self, code):
+        entry = self.entry(code)
+        return None if entry is None else entry[1]
+
+    def best_label(self, code):
+        runs = self.runs(code)
+        return int(runs[0]) if runs is not None and len(runs) else None
+
+    def lookup(self, names):
+        """ค้นหารหัสหลายตัวในครั้งเดียว คืน (มีข้อมูล, ผ่าน RFT, label ของแถวที่ดีที่สุด หรือ -1)"""
+        names = np.asarray(names, dtype=str)
+        known = np.zeros(len(names), dtype=bool)
+        rft = np.zeros(len(names), dtype=bool)
+        best = np.full(len(names), -1, dtype=np.int64)
+        if len(self.codes) and len(names):
+            positions = np.minimum(np.searchsorted(self.codes, names), len(self.codes) - 1)
+            known = self.codes[positions] == names
+            rft = known & self.rft[positions]
+            has_runs = known & (self.offsets[positions + 1] > self.offsets[positions])
+            best[has_runs] = self.labels[self.offsets[positions[has_runs]]]
+        if self.updates:
+            for i in np.flatnonzero(np.isin(names, list(self.updates))):
+                passed, labels = self.updates[str(names[i])]
+                known[i], rft[i], best[i] = True, passed, labels[0] if len(labels) else -1
+        return known, rft, best
+
+    def product_codes(self):
+        """รหัส Product ทั้งหมดที่เรียงแล้ว"""
+        if not self.updates:
+            return self.codes
+        return np.union1d(self.codes, np.asarray(list(self.updates), dtype=str))
+
+    def best_rows(self):
+        """(รหัส, label ของแถวที่ดีที่สุด) ของทุก Product ที่มีแถวที่ผ่าน RFT และมี Throughput เรียงตามรหัส"""
+        has_runs = np.diff(self.offsets) > 0
+        codes, labels = self.codes[has_runs], self.labels[self.offsets[:-1][has_runs]]
+        if self.updates:
+            keep = ~np.isin(codes, list(self.updates))
+            updated = [(code, labels[0]) for code, (_, labels) in self.updates.items() if len(labels)]
+            codes = np.concatenate([codes[keep], np.asarray([code for code, _ in updated], dtype=str)])
+            labels = np.concatenate([labels[keep], np.asarray([label for _, label in updated], dtype=np.int64)])
+            order = np.argsort(codes, kind='stable')
+            codes, labels = codes[order], labels[order]
+        return codes, labels
+
+    def merge(self, batch, data):
+        """รวม index ของข้อมูลชุดใหม่ โดยไม่ต้องสแกนข้อมูลเก่าใหม่ (อัปเดตเฉพาะ Product ที่มีข้อมูลใหม่)"""
+        updates = dict(self.updates)
+        merged, combined = [], []
+        for i, code in enumerate(batch.codes.tolist()):
+            passed = bool(batch.rft[i])
+            labels = batch.labels[batch.offsets[i]:batch.offsets[i + 1]]
+            current = self.entry(code)
+            if current is not None:
+                passed = passed or current[0]
+                if len(current[1]) and len(labels):
+                    # รวมลำดับของแถวเดิมกับแถวใหม่ (ถ้าเท่ากันแถวเดิมมาก่อน)
+                    merged.append(code)
+                    combined.append(np.concatenate([current[1], labels]))
+                elif len(current[1]):
+                    labels = current[1]
+            updates[code] = (passed, labels)
+
+        if combined:
+            # อ่าน Throughput ของทุก Product ที่ต้องรวมในครั้งเดียว
+            throughput = np.split(data.take('Throughput mill (kg/h)', np.concatenate(combined)),
+                                  np.cumsum([len(labels) for labels in combined])[:-1])
+            for code, labels, values in zip(merged, combined, throughput):
+                updates[code] = (updates[code][0], labels[np.argsort(-values, kind='stable')])
+        return BestRunIndex(self.codes, self.rft, self.offsets, self.labels, updates)
+
+def build_best_run_index(data):
+    """สร้าง index ของแถวที่ผ่าน RFT และมี Throughput mill สูงสุดของแต่ละ Product (key เป็นตัวพิมพ์ใหญ่)"""
+    return BestRunIndex.from_frame(data)
+
+def merge_best_run_index(index, batch_index, data):
+    """รวม index ของข้อมูลชุดใหม่เข้ากับ index เดิม โดยไม่ต้องสแกนข้อมูลเก่าใหม่"""
+    return index.merge(batch_index, data)
+
+class QuantileSketch:
+    """sketch สำหรับประมาณ quantile แบบ relative error (แบ่ง bucket ตาม log ของค่า) รวมกันได้ด้วยการบวกจำนวนในแต่ละ bucket
+
+    ค่า quantile คลาดเคลื่อนไม่เกิน SKETCH_ACCURACY ของค่าจริง ส่วน min/max เก็บค่าจริง ค่าที่ <= 0 อยู่ใน bucket ZERO_BUCKET
+    ไม่แก้ไข sketch เดิม (merge คืน sketch ใหม่) เพื่อให้อ่านจาก request อื่นได้ระหว่างอัปเดต
+    """
+
+    def __init__(self, keys=None, counts=None, minimum=None, maximum=None, count=None):
+        self.keys = np.empty(0, dtype=np.int64) if keys is None else keys
+        self.counts = np.empty(0, dtype=np.int64) if counts is None else counts
+        self.count = int(self.counts.sum()) if count is None else count
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+        keys, inverse = np.unique(np.concatenate([self.keys, other.keys]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([self.counts, other.counts])).astype(np.int64)
+        return QuantileSketch(keys, counts, min(self.minimum, other.minimum), max(self.maximum, other.maximum))
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        # nearest-rank: ค่าลำดับที่ ceil(q * count)
+        rank = max(int(np.ceil(q * self.count)) - 1, 0)
+        key = self.keys[np.searchsorted(np.cumsum(self.counts), rank, side='right')]
+        if key == ZERO_BUCKET:
+            return self.minimum
+        estimate = 2 * SKETCH_GAMMA ** float(key) / (SKETCH_GAMMA + 1)
+        return min(max(estimate, self.minimum), self.maximum)
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0, "min": None, "median": None, "p90": None, "max": None}
+        return {
+            "count": self.count,
+            "min": self.minimum,
+            "median": round(self.quantile(0.5), 2),
+            "p90": round(self.quantile(0.9), 2),
+            "max": self.maximum,
+        }
+
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = np.log(SKETCH_GAMMA)
+ZERO_BUCKET = np.iinfo(np.int64).min
+
+STATS_METRICS = ['Throughput mill (kg/h)', 'Throughput ext.(kg/h)']
+
+# รวม part ของสถิติเป็น part เดียวเมื่อมีจำนวนเกินกำหนด
+STATS_MAX_PARTS = int(os.environ.get('STATS_MAX_PARTS', '8'))
+
+def sketch_buckets(values):
+    buckets = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+    positive = values > 0
+    buckets[positive] = np.ceil(np.log(values[positive]) / SKETCH_LOG_GAMMA).astype(np.int64)
+    return buckets
+
+def group_extreme(ids, values, groups, reducer):
+    # min/max ต่อกลุ่ม (NaN ถ้ากลุ่มนั้นไม่มีค่า)
+    result = np.full(groups, np.nan)
+    valid = ~np.isnan(values)
+    if valid.any():
+        extremes = pd.Series(values[valid]).groupby(ids[valid]).agg(reducer)
+        result[extremes.index.to_numpy()] = extremes.to_numpy()
+    return result
 
-    # หยิบค่ามากที่สุดของ Throughput mill (kg/h)
-    filtered_sorted = filtered_df.sort_values(by='Throughput mill (kg/h)', ascending=False)
+class ThroughputStatsPart:
+    """สถิติของกลุ่ม (Product, Line, Mill) เก็บเป็น array เรียงตาม key เพื่อหา Product ด้วย searchsorted
+
+    sketch ของแต่ละคอลัมน์ Throughput เก็บแบบ CSR: bucket ของกลุ่ม g อยู่ที่ keys/counts[offsets[g]:offsets[g + 1]]
+    """
+
+    def __init__(self, names, products, lines, mills, runs, passed, sources):
+        """รวมแถว input ที่มี key (products, lines, mills) ซ้ำกันเป็นกลุ่มเดียว
+
+        names: รหัส Product ที่เรียงแล้ว และ products: ตำแหน่งของรหัสของแต่ละแถวใน names
+        sources: {metric: (input id, bucket key, count, min, max)} โดย input id ชี้ไปยังแถวของ input
+        """
+        frame = pd.DataFrame({'product': products, 'line': lines, 'mill': mills})
+        ids = frame.groupby(['product', 'line', 'mill'], dropna=False, sort=True).ngroup().to_numpy()
+        groups = int(ids.max()) + 1 if len(ids) else 0
+        _, first = np.unique(ids, return_index=True)
+        self.products = np.asarray(names, dtype=str)[products[first]]
+        self.lines = np.asarray(lines, dtype=np.float64)[first]
+        self.mills = np.asarray(mills, dtype=np.float64)[first]
+        self.runs = np.bincount(ids, weights=runs, minlength=groups).astype(np.int64)
+        self.passed = np.bincount(ids, weights=passed, minlength=groups).astype(np.int64)
+
+        self.sketches = {}
+        for metric, (source, keys, counts, minimum, maximum) in sources.items():
+            group_ids = ids[source]
+            order = np.lexsort((keys, group_ids))
+            group_ids, keys, counts = group_ids[order], keys[order], counts[order]
+            starts = np.flatnonzero(np.r_[True, (group_ids[1:] != group_ids[:-1]) | (keys[1:] != keys[:-1])]) if len(keys) else keys[:0]
+            self.sketches[metric] = {
+                "offsets": np.searchsorted(group_ids[starts], np.arange(groups + 1)),
+                "keys": keys[starts],
+                "counts": np.add.reduceat(counts, starts) if len(starts) else counts[:0],
+                "min": group_extreme(ids, minimum, groups, 'min'),
+                "max": group_extreme(ids, maximum, groups, 'max'),
+            }
+
+    def __len__(self):
+        return len(self.products)
+
+    def to_arrays(self):
+        """array ของ part สำหรับบันทึกลง snapshot (sketch ของ metric ที่ i ใช้ชื่อ "i.offsets", "i.keys", ...)"""
+        arrays = {"products": self.products, "lines": self.lines, "mills": self.mills, "runs": self.runs, "passed": self.passed}
+        for i, metric in enumerate(STATS_METRICS):
+            arrays.update({f"{i}.{key}": values for key, values in self.sketches[metric].items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        part = cls.__new__(cls)
+        for key in ("products", "lines", "mills", "runs", "passed"):
+            setattr(part, key, arrays[key])
+        part.sketches = {metric: {key: arrays[f"{i}.{key}"] for key in ("offsets", "keys", "counts", "min", "max")}
+                         for i, metric in enumerate(STATS_METRICS)}
+        return part
+
+    def groups(self, product):
+        start = np.searchsorted(self.products, product, side='left')
+        end = np.searchsorted(self.products, product, side='right')
+        return range(start, end)
+
+    def sketch(self, metric, group):
+        sketch = self.sketches[metric]
+        start, end = sketch["offsets"][group], sketch["offsets"][group + 1]
+        if start == end:
+            return QuantileSketch()
+        return QuantileSketch(sketch["keys"][start:end], sketch["counts"][start:end],
+                              float(sketch["min"][group]), float(sketch["max"][group]))
+
+def build_throughput_stats_part(data):
+    """สรุปจำนวนแถว จำนวนที่ผ่าน RFT และ sketch ของ Throughput (เฉพาะแถวที่ผ่าน RFT) แยกตาม Product, Line, Mill"""
+    # แปลงเป็นตัวพิมพ์ใหญ่เฉพาะ category แล้วจัดลำดับรหัสด้วย code ของ category (ไม่ต้องเทียบ string ทุกแถว)
+    categories = pd.Categorical(data['Product'])
+    category_ids, names = pd.factorize(np.asarray(categories.categories.astype(str).str.upper(), dtype=object), sort=True)
+    present = categories.codes >= 0
+    products = category_ids[categories.codes[present]]
+    passed = (data['RFT-ext.'] & data['RFT-Mill']).to_numpy()[present]
+    sources = {}
+    for metric in STATS_METRICS:
+        values = data[metric].to_numpy(dtype=np.float64)[present]
+        rows = np.flatnonzero(passed & ~np.isnan(values))
+        picked = np.full(len(values), np.nan)
+        picked[rows] = values[rows]
+        sources[metric] = (rows, sketch_buckets(values[rows]), np.ones(len(rows), dtype=np.int64), picked, picked)
+    return ThroughputStatsPart(
+        names, products,
+        pd.to_numeric(data['Line'], errors='coerce').to_numpy(dtype=np.float64)[present],
+        pd.to_numeric(data['Mill'], errors='coerce').to_numpy(dtype=np.float64)[present],
+        np.ones(len(products), dtype=np.int64), passed.astype(np.int64), sources,
+    )
 
-    logging.debug(f"Sorted DataFrame: {filtered_sorted}")
+def combine_throughput_parts(parts):
+    """รวมหลาย part เป็น part เดียว (ผลเท่ากับสร้างจากข้อมูลทั้งหมดในครั้งเดียว)"""
+    if len(parts) == 1:
+        return parts[0]
+    sources = {}
+    for metric in STATS_METRICS:
+        source, keys, counts = [], [], []
+        base = 0
+        for part in parts:
+            sketch = part.sketches[metric]
+            source.append(base + np.repeat(np.arange(len(part)), np.diff(sketch["offsets"])))
+            keys.append(sketch["keys"])
+            counts.append(sketch["counts"])
+            base += len(part)
+        sources[metric] = (
+            np.concatenate(source), np.concatenate(keys), np.concatenate(counts),
+            np.concatenate([part.sketches[metric]["min"] for part in parts]),
+            np.concatenate([part.sketches[metric]["max"] for part in parts]),
+        )
+    products, names = pd.factorize(np.concatenate([part.products for part in parts]).astype(object), sort=True)
+    return ThroughputStatsPart(
+        names, products,
+        np.concatenate([part.lines for part in parts]),
+        np.concatenate([part.mills for part in parts]),
+        np.concatenate([part.runs for part in parts]),
+        np.concatenate([part.passed for part in parts]),
+        sources,
+    )
 
-    top_entry = filtered_sorted.iloc[0].dropna(how='all')
+class ThroughputStats:
+    """สถิติ Throughput ของทุก Product: part ของข้อมูลตอนโหลด + part ของข้อมูลที่ append เข้ามาแต่ละครั้ง
+
+    สร้าง QuantileSketch ของ Product เฉพาะตอนที่มี request ขอ (รวมข้าม part ตาม Line/Mill)
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def merge(self, other):
+        parts = self.parts + other.parts
+        if len(parts) > STATS_MAX_PARTS:
+            # รวมเฉพาะ part ของข้อมูลที่ append เข้ามา ไม่ต้องประมวลผล part หลักใหม่
+            parts = [parts[0], combine_throughput_parts(parts[1:])]
+        return ThroughputStats(parts)
+
+    def product(self, product):
+        """คืน {(line, mill): {"runs", "rft_passed", metric: QuantileSketch}} ของ Product หรือ None ถ้าไม่มีข้อมูล"""
+        groups = {}
+        for part in self.parts:
+            for group in part.groups(product):
+                key = (machine_key(part.lines[group]), machine_key(part.mills[group]))
+                entry = groups.setdefault(key, {"runs": 0, "rft_passed": 0, **{metric: QuantileSketch() for metric in STATS_METRICS}})
+                entry["runs"] += int(part.runs[group])
+                entry["rft_passed"] += int(part.passed[group])
+                for metric in STATS_METRICS:
+                    entry[metric] = entry[metric].merge(part.sketch(metric, group))
+        return groups or None
+
+def machine_key(value):
+    # หมายเลขเครื่องเป็น int (None ถ้าไม่มีค่า)
+    return None if np.isnan(value) else int(value)
+
+def build_throughput_stats(data):
+    return ThroughputStats([build_throughput_stats_part(data)])
+
+def merge_throughput_stats(stats, batch_stats):
+    """รวมสถิติของแถวใหม่เข้ากับสถิติเดิม โดยเพิ่มเป็น part ใหม่ (ไม่ประมวลผลข้อมูลเก่าซ้ำ)"""
+    return stats.merge(batch_stats)
+
+# จำนวนและระยะห่าง (edit distance) สูงสุดของรหัสที่แนะนำเมื่อไม่พบ Product
+SUGGESTION_LIMIT = 5
+SUGGESTION_MAX_DISTANCE = 3
+# จำนวนรหัสที่มี trigram ตรงกันมากที่สุด ที่นำมาคำนวณ edit distance
+SUGGESTION_CANDIDATES = 10
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance ของ a กับ b หยุดเมื่อเกิน limit (คืน limit + 1)"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def code_gram_pairs(codes, first_id=0):
+    """trigram ของทุกรหัสแบบ vectorized คืน (gram key, id) เรียงตาม key โดย id ของ codes[i] คือ first_id + i
+
+    แต่ละ trigram เข้ารหัสเป็น int64 (ตัวอักษรละ 21 bit) รหัสเติม "$$" ข้างหน้าและ "$" ข้างหลัง
+    """
+    if len(codes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    padded = np.char.add(np.char.add('$$', np.asarray(codes, dtype=str)), '$')
+    width = padded.dtype.itemsize // 4
+    chars = padded.view(np.uint32).reshape(len(padded), width).astype(np.int64)
+    keys = (chars[:, :-2] << 42) | (chars[:, 1:-1] << 21) | chars[:, 2:]
+    valid = np.arange(width - 2) < (np.char.str_len(padded) - 2)[:, None]
+    ids = np.broadcast_to(np.arange(first_id, first_id + len(padded))[:, None], keys.shape)[valid]
+    keys = keys[valid]
+
+    # เรียงตาม (key, id) แล้วตัด trigram ที่ซ้ำในรหัสเดียวกันออก
+    order = np.lexsort((ids, keys))
+    keys, ids = keys[order], ids[order]
+    distinct = np.r_[True, (keys[1:] != keys[:-1]) | (ids[1:] != ids[:-1])]
+    return keys[distinct], ids[distinct]
+
+class ProductCodeIndex:
+    """index ของรหัส Product (ตัวพิมพ์ใหญ่) สำหรับค้นหาตาม prefix (sorted array) และหารหัสที่ใกล้เคียง (trigram + edit distance)
+
+    postings ของ trigram เก็บเป็น array คู่ (gram key, id) ที่เรียงตาม key โดย id ชี้ไปที่ names (เรียงตามลำดับที่เพิ่มเข้ามา)
+    ไม่แก้ไข index เดิม (with_codes คืน index ใหม่) เพื่อให้ request อื่นอ่านได้ระหว่างอัปเดต
+    """
+
+    def __init__(self, codes=()):
+        self.codes = np.array(sorted(codes), dtype=str)
+        self.names = self.codes
+        self.gram_keys, self.gram_ids = code_gram_pairs(self.codes)
+
+    def to_arrays(self):
+        # names เท่ากับ codes เสมอใน index ที่สร้างจาก __init__ จึงไม่ต้องบันทึกซ้ำ
+        return {"codes": self.codes, "gram_keys": self.gram_keys, "gram_ids": self.gram_ids}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.codes = index.names = arrays["codes"]
+        index.gram_keys, index.gram_ids = arrays["gram_keys"], arrays["gram_ids"]
+        return index
+
+    def with_codes(self, new_codes):
+        """เพิ่มรหัสใหม่โดยแทรกเข้า array ที่เรียงไว้แล้ว แทนการสร้าง index ใหม่ทั้งหมด"""
+        new_codes = np.array(sorted(new_codes), dtype=str)
+        if len(new_codes) == 0:
+            return self
+        dtype = np.result_type(self.codes.dtype, new_codes.dtype)
+        index = ProductCodeIndex.__new__(ProductCodeIndex)
+        codes = self.codes.astype(dtype, copy=False)
+        index.codes = np.insert(codes, np.searchsorted(codes, new_codes), new_codes.astype(dtype))
+        index.names = np.concatenate([self.names.astype(dtype, copy=False), new_codes.astype(dtype)])
+        keys, ids = code_gram_pairs(new_codes, len(self.names))
+        positions = np.searchsorted(self.gram_keys, keys, side='right')
+        index.gram_keys = np.insert(self.gram_keys, positions, keys)
+        index.gram_ids = np.insert(self.gram_ids, positions, ids)
+        return index
+
+    def prefix(self, query, limit):
+        start = np.searchsorted(self.codes, query, side='left')
+        end = np.searchsorted(self.codes, query + '\U0010ffff', side='left')
+        return self.codes[start:min(end, start + limit)].tolist()
+
+    def similar(self, query, limit=SUGGESTION_LIMIT, max_distance=SUGGESTION_MAX_DISTANCE):
+        """รหัสที่ใกล้เคียงที่สุด เรียงตาม edit distance คืน list ของ (code, distance)"""
+        keys, _ = code_gram_pairs([query])
+        starts = np.searchsorted(self.gram_keys, keys, side='left')
+        ends = np.searchsorted(self.gram_keys, keys, side='right')
+        postings = [self.gram_ids[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+        if not postings:
+            return []
+        ids, overlap = np.unique(np.concatenate(postings), return_counts=True)
+        if len(ids) > SUGGESTION_CANDIDATES:
+            cutoff = np.sort(overlap)[-SUGGESTION_CANDIDATES]
+            above, tied = ids[overlap > cutoff], ids[overlap == cutoff]
+            # รหัสที่ overlap เท่ากันที่ขอบ เลือกตามลำดับตัวอักษร ผลจึงไม่ขึ้นกับลำดับที่รหัสถูกเพิ่มเข้ามา
+            tied = tied[np.argsort(self.names[tied], kind='stable')][:SUGGESTION_CANDIDATES - len(above)]
+            ids = np.concatenate([above, tied])
+        candidates = self.names[ids].tolist()
+        scored = sorted((edit_distance(query, code, max_distance), code) for code in candidates)
+        return [(code, distance) for distance, code in scored if distance <= max_distance][:limit]
+
+    def suggest(self, query):
+        return [code for code, _ in self.similar(query)]
+
+def extended_indexes(indexes, new_rows, data):
+    """คืนโครงสร้างข้อมูลที่คำนวณล่วงหน้าชุดใหม่ ที่รวมแถวที่ append เข้ามาใหม่ (ประมวลผลเฉพาะแถวใหม่)"""
+    best_run, stats, code_index = indexes
+    with stage_timer("index_update"):
+        batch_index = build_best_run_index(new_rows)
+        new_products = np.setdiff1d(batch_index.codes, best_run.product_codes())
+        return (
+            merge_best_run_index(best_run, batch_index, data),
+            merge_throughput_stats(stats, build_throughput_stats(new_rows)),
+            # เพิ่มเฉพาะรหัส Product ใหม่เข้า index ของรหัส
+            code_index.with_codes(new_products),
+        )
+
+def snapshot_indexes(data):
+    """array ของ index ของส่วนหลักที่บันทึกลง snapshot {ชนิด: {ชื่อ: array}}"""
+    best_run = build_best_run_index(data)
+    return {
+        "best_run": best_run.to_arrays(),
+        "throughput_stats": build_throughput_stats_part(data).to_arrays(),
+        "product_codes": ProductCodeIndex(best_run.codes).to_arrays(),
+    }
 
-    logging.debug(f"Top Entry: {top_entry}")
+def build_indexes(data):
+    """สร้างโครงสร้างข้อมูลที่คำนวณล่วงหน้าทั้งหมดจาก data คืน (best_run_index, throughput_stats, product_code_index)
+
+    index ของส่วนหลักใช้ array จาก snapshot ถ้ามี (map ไว้ ไม่ต้องสร้างใหม่และใช้หน่วยความจำร่วมกับ worker อื่น)
+    """
+    base, *appended = data.chunks
+    with stage_timer("index_build"):
+        if data.base_indexes is not None:
+            arrays = data.base_indexes
+            indexes = (BestRunIndex.from_arrays(arrays["best_run"]),
+                       ThroughputStats([ThroughputStatsPart.from_arrays(arrays["throughput_stats"])]),
+                       ProductCodeIndex.from_arrays(arrays["product_codes"]))
+        else:
+            best_run = build_best_run_index(base)
+            indexes = (best_run, build_throughput_stats(base), ProductCodeIndex(best_run.codes))
+    for chunk in appended:
+        indexes = extended_indexes(indexes, chunk, data)
+    return indexes
+
+def install_data(data, indexes):
+    """เปลี่ยน df และโครงสร้างข้อมูลที่คำนวณล่วงหน้าเป็นชุดใหม่ที่สร้างเสร็จแล้ว
+
+    เปลี่ยน df ก่อน เพราะ label ของแถวเดิมยังชี้ไปที่แถวเดียวกันใน df ชุดใหม่ (append และ compact ไม่เปลี่ยนลำดับแถว)
+    """
+    global df, best_run_index, throughput_stats, product_code_index
+    df = data
+    best_run_index, throughput_stats, product_code_index = indexes
+
+def extend_indexes(new_rows):
+    """อัปเดตโครงสร้างข้อมูลที่คำนวณล่วงหน้าด้วยแถวที่ append เข้ามาใหม่เท่านั้น"""
+    install_data(df, extended_indexes((best_run_index, throughput_stats, product_code_index), new_rows, df))
+
+def load_startup_data():
+    """โหลดข้อมูลและ index ตอนเริ่ม worker"""
+    try:
+        with storage_lock():
+            # ลบ segment ที่รวมเข้า RFT 2024.csv แล้ว แต่ยังค้างอยู่เพราะ process หยุดระหว่าง compact
+            for name in folded_segments():
+                remove_file(os.path.join(segment_dir, name))
+            startup_segments = list_segments()
+            data = load_rft_data(startup_segments)
+            set_loaded_state(generation=read_generation(), base=source_fingerprint(file_path), segments=set(startup_segments))
+    except Exception as e:
+        raise Exception(f"Error loading CSV file: {e}")
+    install_data(data, build_indexes(data))
+
+# python main.py build-snapshot ไม่ต้องโหลดข้อมูล (ดูท้ายไฟล์)
+if __name__ != '__main__':
+    load_startup_data()
+
+def append_segments(data, indexes, segments, loaded_segments):
+    """ต่อ segment ที่ยังไม่อยู่ใน loaded_segments เข้ากับ data คืน (data, indexes) ชุดใหม่"""
+    for path in segments:
+        if path not in loaded_segments:
+            data, new_rows = data.append(pd.read_csv(path))
+            indexes = extended_indexes(indexes, new_rows, data)
+    return data, indexes
+
+def storage_compacted():
+    # RFT 2024.csv ถูก compact ไปหลังจากที่ worker นี้โหลดไว้ (ต้องเรียกขณะถือ storage_lock)
+    return source_fingerprint(file_path) != loaded_state["base"] or not loaded_state["segments"].issubset(list_segments())
+
+def sync_with_storage():
+    """โหลดข้อมูลที่ worker อื่น append หรือ compact ไว้ ถ้า generation บนดิสก์เปลี่ยนไป (ต้องเรียกขณะถือ storage_lock)
+
+    หลังการ compact ควรเรียก reload_storage ก่อน ซึ่งโหลดข้อมูลนอกล็อก ที่นี่จะโหลดใหม่ทั้งหมดเฉพาะกรณีที่ยังไม่ได้ทำ
+    """
+    generation = read_generation()
+    if generation == loaded_state["generation"]:
+        return False
+
+    base = source_fingerprint(file_path)
+    segments = list_segments()
+    if storage_compacted():
+        data = load_rft_data(segments)
+        install_data(data, build_indexes(data))
+    else:
+        # โหลดเฉพาะ segment ใหม่ที่ worker อื่นเพิ่มเข้ามา
+        install_data(*append_segments(df, (best_run_index, throughput_stats, product_code_index),
+                                      segments, loaded_state["segments"]))
+
+    set_loaded_state(generation=generation, base=base, segments=set(segments))
+    invalidate_ranked_data()
+    logging.info("Loaded RFT data generation %d", generation)
+    return True
+
+# จำนวนครั้งที่ลองโหลดใหม่นอกล็อก ถ้ามีการ compact ซ้ำระหว่างโหลด
+RELOAD_ATTEMPTS = 3
+
+def reload_storage(force=False):
+    """โหลดข้อมูลใหม่ทั้งหมดหลังการ compact: อ่าน snapshot และสร้าง index โดยไม่ถือ storage_lock แล้วค่อยสลับเข้ามา
+
+    ถือล็อกเฉพาะตอนตรวจสถานะและตอนต่อ segment ที่ถูกเพิ่มระหว่างโหลด ถ้าไม่ได้ถูก compact จะโหลดเฉพาะ segment ใหม่
+    force=True ใช้หลัง compact ใน worker นี้เอง เพื่อให้ df ชี้ไปที่ snapshot ใหม่ที่ map ไว้ (ใช้หน่วยความจำร่วมกับ worker อื่น)
+    """
+    for _ in range(RELOAD_ATTEMPTS):
+        with storage_lock():
+            if not force and not storage_compacted():
+                sync_with_storage()
+                return
+            base = source_fingerprint(file_path)
+            segments = list_segments()
+
+        try:
+            data = load_rft_data(segments)
+            indexes = build_indexes(data)
+        except FileNotFoundError:
+            # segment ถูก compact ไประหว่างโหลด ลองใหม่
+            continue
 
-    # แปลงคอลัมน์ที่จำเป็นเป็นตัวเลข
-    numeric_columns = ['Line', 'Mill', 'Throughput mill (kg/h)', 'Throughput ext.(kg/h)',
-                       'Dosing', 'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5',
-                       'Screw speed', 'Torque', 'Feed', 'Sep.', 'Rotor', 'Air flow']
-    for col in numeric_columns:
+        with storage_lock():
+            current = list_segments()
+            if source_fingerprint(file_path) != base or not set(segments).issubset(current):
+                continue
+            data, indexes = append_segments(data, indexes, current, set(segments))
+            install_data(data, indexes)
+            generation = read_generation()
+            set_loaded_state(generation=generation, base=base, segments=set(current))
+        invalidate_ranked_data()
+        logging.info("Reloaded RFT data generation %d", generation)
+        return
+
+    with storage_lock():
+        sync_with_storage()
+
+storage_reload_task = None
+
+@app.middleware("http")
+async def sync_storage_middleware(request: Request, call_next):
+    # ตรวจ generation ทุก request (อ่านไฟล์เล็กๆ ไฟล์เดียว) แล้วโหลด segment ใหม่ใน thread ถ้ามีการเปลี่ยนแปลง
+    global storage_reload_task
+    if read_generation() != loaded_state["generation"]:
+        def sync():
+            # ไม่รอล็อก: ถ้ามีการ append/compact อยู่ ให้ตอบจากข้อมูลที่โหลดไว้ แล้วค่อย sync ใน request ถัดไป
+            with storage_lock(blocking=False) as locked:
+                if not locked:
+                    return False
+                if storage_compacted():
+                    return True
+                sync_with_storage()
+                return False
+
+        # ถ้าถูก compact ให้โหลดใหม่เบื้องหลัง ระหว่างนั้นตอบจากข้อมูลเดิม (แถวเดียวกับ RFT 2024.csv ที่ compact แล้ว)
+        if await run_in_threadpool(sync) and (storage_reload_task is None or storage_reload_task.done()):
+            storage_reload_task = asyncio.create_task(run_in_threadpool(reload_storage))
+    return await call_next(request)
+
+def round_tens(value):
+    if pd.isnull(value):
+        return value
+    try:
+        numeric_value = float(value)
+        return int(round(numeric_value / 10) * 10)
+    except ValueError:
+        return value  # ถ้าไม่สามารถแปลงเป็นตัวเลขได้ ให้คืนค่าดั้งเดิม
+
+def round_torque(value):
+    if pd.isnull(value):
+        return value
+    try:
+        numeric_value = float(value)
+        if numeric_value % 10 in [3, 4, 6, 7]:
+            return (numeric_value // 10) * 10 + 5
+        elif numeric_value % 10 in [1, 2]:
+            return (numeric_value // 10) * 10
+        elif numeric_value % 10 in [8, 9]:
+            return (numeric_value // 10) * 10 + 10
+        else:
+            return round(numeric_value, 2)
+    except ValueError:
+        return value  # ถ้าไม่สามารถแปลงเป็นตัวเลขได้ ให้คืนค่าดั้งเดิม
+
+def keep_text(values, numeric, converted):
+    # ค่าที่แปลงเป็นตัวเลขไม่ได้ ให้คืนค่าดั้งเดิม (เหมือน round_tens/round_torque)
+    text = values.notna() & numeric.isna()
+    if not text.any():
+        return converted
+    return converted.astype(object).where(~text, values)
+
+def round_tens_column(values):
+    """round_tens ทั้งคอลัมน์ในครั้งเดียว"""
+    numeric = pd.to_numeric(values, errors='coerce')
+    return keep_text(values, numeric, (np.round(numeric / 10) * 10).astype('Int64'))
+
+def round_torque_column(values):
+    """round_torque ทั้งคอลัมน์ในครั้งเดียว"""
+    numeric = pd.to_numeric(values, errors='coerce')
+    remainder = numeric % 10
+    base = (numeric // 10) * 10
+    rounded = np.select(
+        [remainder.isin([3, 4, 6, 7]), remainder.isin([1, 2]), remainder.isin([8, 9])],
+        [base + 5, base, base + 10],
+        default=numeric.round(2),
+    )
+    return keep_text(values, numeric, pd.Series(rounded, index=values.index))
+
+def filter_parameters(params):
+    for key, value in params.items():
+        if key in ['HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed']:
+            params[key] = round_tens(value)
+        elif key == 'Torque':
+            params[key] = round_torque(value)
+        else:
+            params[key] = value
+    return params
+
+# แปลงค่าใน result ให้เป็นประเภทข้อมูลมาตรฐาน
+def convert_values(obj):
+    if isinstance(obj, dict):
+        return {k: convert_values(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_values(i) for i in obj]
+    elif isinstance(obj, (np.integer, np.int64, np.int32)):
+        return int(obj)
+    elif isinstance(obj, (np.floating, np.float64, np.float32)):
+        return None if np.isnan(obj) else float(obj)
+    elif isinstance(obj, float) and np.isnan(obj):
+        return None
+    else:
+        return obj
+
+# คอลัมน์ที่ต้องแปลงเป็นตัวเลขก่อนส่งกลับ
+NUMERIC_RESULT_COLUMNS = ['Line', 'Mill', 'Throughput mill (kg/h)', 'Throughput ext.(kg/h)',
+                          'Dosing', 'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5',
+                          'Screw speed', 'Torque', 'Feed', 'Sep.', 'Rotor', 'Air flow']
+
+def build_product_result(entry):
+    """สร้างผลลัพธ์ extrude/mill จากแถวที่ดีที่สุดของ Product"""
+    top_entry = dict(entry)
+    for col in NUMERIC_RESULT_COLUMNS:
         if col in top_entry and pd.notnull(top_entry[col]):
             try:
-                top_entry[col] = float(top_entry[col])
+                # float32 แปลงผ่าน str เพื่อให้ได้ค่าทศนิยมตามที่บันทึกไว้ (เช่น 2.3 แทน 2.299999952316284)
+                top_entry[col] = float(str(top_entry[col])) if isinstance(top_entry[col], np.float32) else float(top_entry[col])
             except ValueError:
                 pass  # ถ้าแปลงไม่ได้ ให้ข้ามไป
 
-    def filter_parameters(params):
-        def round_tens(value):
-            if pd.isnull(value):
-                return value
-            try:
-                numeric_value = float(value)
-                return int(round(numeric_value / 10) * 10)
-            except ValueError:
-                return value  # ถ้าไม่สามารถแปลงเป็นตัวเลขได้ ให้คืนค่าดั้งเดิม
-
-        def round_torque(value):
-            if pd.isnull(value):
-                return value
-            try:
-                numeric_value = float(value)
-                if numeric_value % 10 in [3, 4, 6, 7]:
-                    return (numeric_value // 10) * 10 + 5
-                elif numeric_value % 10 in [1, 2]:
-                    return (numeric_value // 10) * 10
-                elif numeric_value % 10 in [8, 9]:
-                    return (numeric_value // 10) * 10 + 10
-                else:
-                    return round(numeric_value, 2)
-            except ValueError:
-                return value  # ถ้าไม่สามารถแปลงเป็นตัวเลขได้ ให้คืนค่าดั้งเดิม
-
-        for key, value in params.items():
-            if key in ['HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed']:
-                params[key] = round_tens(value)
-            elif key == 'Torque':
-                params[key] = round_torque(value)
-            else:
-                params[key] = value
-        return params
+    result = {"extrude": {}, "mill": {}}
 
     # คืน Extrude และข้อมูลใน Column ต่างๆของมัน
     result["extrude"]["Machine no."] = int(top_entry.get('Line')) if pd.notnull(top_entry.get('Line')) else 'N/A'
-    extrude_params = top_entry[['Dosing', 'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed', 'Torque']].to_dict()
+    extrude_params = {key: top_entry.get(key) for key in ['Dosing', 'Suggestion Side feed', 'HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed', 'Torque']}
     result["extrude"]["Parameters"] = filter_parameters(extrude_params)
 
     # คืน Mill และข้อมูลใน Column ต่างๆของมัน
     result["mill"]["Machine no."] = int(top_entry.get('Mill')) if pd.notnull(top_entry.get('Mill')) else 'N/A'
-    mill_params = top_entry[['Feed', 'Sep.', 'Rotor', 'Air flow']].to_dict()
+    mill_params = {key: top_entry.get(key) for key in ['Feed', 'Sep.', 'Rotor', 'Air flow']}
     result["mill"]["Parameters"] = filter_parameters(mill_params)
 
     # คืน Throughput
     result["mill"]["Throughput"] = float(top_entry['Throughput mill (kg/h)']) if pd.notnull(top_entry['Throughput mill (kg/h)']) else None
 
-    # แปลงค่าใน result ให้เป็นประเภทข้อมูลมาตรฐาน
-    def convert_values(obj):
-        if isinstance(obj, dict):
-            return {k: convert_values(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [convert_values(i) for i in obj]
-        elif isinstance(obj, (np.integer, np.int64, np.int32)):
-            return int(obj)
-        elif isinstance(obj, (np.floating, np.float64, np.float32)):
-            return float(obj)
-        else:
-            return obj
+    return convert_values(result)
+
+# cache ของ response ที่ serialize แล้ว (LRU) key ประกอบด้วย request ที่ normalize แล้วและ tag ของข้อมูล
+response_cache_size = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+
+def etag_matches(http_request, etag):
+    if http_request is None:
+        return False
+    header = http_request.headers.get('if-none-match')
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def cached_json_response(http_request, key, compute):
+    """คืนผลลัพธ์จาก cache ถ้ามี ไม่เช่นนั้นเรียก compute() พร้อมใส่ ETag และตอบ 304 ถ้า client มีข้อมูลล่าสุดอยู่แล้ว"""
+    tag = loaded_state["tag"]
+    digest = hashlib.sha1(json.dumps(key, ensure_ascii=False).encode()).hexdigest()[:16]
+    etag = f'"{tag}-{digest}"'
+
+    cache_key = (tag, digest)
+    with response_cache_lock:
+        entry = response_cache.get(cache_key)
+        if entry is not None:
+            response_cache.move_to_end(cache_key)
+
+    if entry is None:
+        result, outcomes = record_outcomes(compute)
+        with stage_timer("serialization"):
+            body = json.dumps(result, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        with response_cache_lock:
+            response_cache[cache_key] = (body, outcomes)
+            while len(response_cache) > response_cache_size:
+                response_cache.popitem(last=False)
+    else:
+        # ตอบจาก cache ก็ต้องนับผลการจัดอันดับเหมือนคำนวณใหม่
+        body, outcomes = entry
+        replay_outcomes(outcomes)
+
+    if etag_matches(http_request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+class ProductNotFoundError(HTTPException):
+    """404 ของ Product ที่ไม่มีในข้อมูล พร้อมรหัสที่ใกล้เคียง"""
+
+    def __init__(self, product_name):
+        super().__init__(status_code=404, detail=f"No data found for product: {product_name}")
+        self.suggestions = product_code_index.suggest(product_name)
+
+@app.exception_handler(ProductNotFoundError)
+async def product_not_found_handler(request: Request, exc: ProductNotFoundError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail, "suggestions": exc.suggestions})
+
+def product_outcome(product_name):
+    """สถานะของ Product ใน index: no_data, no_rft, no_throughput หรือ ok"""
+    return best_run_index.outcome(product_name)
+
+class ProductRequest(BaseModel):
+    product_name: str
+
+@app.post("/rank_product/")
+def rank_product(request: ProductRequest, http_request: Request):
+    product_name = request.product_name.upper()  # เปลี่ยนเป็น Upercase ให้หมดก่อนนำไปหา
+    return cached_json_response(http_request, ["rank_product", product_name], lambda: product_result(product_name))
 
-    result = convert_values(result)
+def product_result(product_name):
+    """หา Product จาก index แล้วสร้างผลลัพธ์ของ /rank_product/"""
+    logging.debug("Received product name: %s", product_name)
 
-    logging.debug(f"Result: {result}")
+    with stage_timer("lookup"):
+        outcome = product_outcome(product_name)
+        # หยิบแถวที่มี Throughput mill (kg/h) มากที่สุดจาก index
+        top_label = best_run_index.best_label(product_name)
+    count_outcome("rank_product", outcome)
+
+    if outcome == "no_data":
+        raise ProductNotFoundError(product_name)
+
+    # มีค่า / ใน Column RFT-ext. และ RFT-Mill
+    if outcome == "no_rft":
+        raise HTTPException(status_code=404, detail="No matching data found for both RFT-ext. and RFT-Mill.")
+
+    if outcome == "no_throughput":
+        return {"warning": "No valid numerical data found in 'Throughput mill (kg/h)' column. Skipping throughput ranking."}
+
+    data = df
+    top_entry = data.record(top_label, [col for col in BEST_RUN_COLUMNS if col in data.columns])
+    logging.debug("Top Entry: %s", top_entry)
+
+    with stage_timer("rounding"):
+        result = build_product_result(top_entry)
+
+    logging.debug("Result: %s", result)
 
     return result
 
+def first_matching_runs(labels, k, line=None, mill=None):
+    """K แถวแรกของ labels (เรียงแล้ว) ที่ตรงกับ Line/Mill ตรวจทีละช่วงและหยุดเมื่อครบ K แถว"""
+    if line is None and mill is None:
+        return labels[:k]
+
+    filters = [(col, value) for col, value in (('Line', line), ('Mill', mill)) if value is not None]
+    data = df
+    found = []
+    start, size = 0, max(4 * k, 64)
+    while start < len(labels) and sum(len(part) for part in found) < k:
+        chunk = labels[start:start + size]
+        keep = np.ones(len(chunk), dtype=bool)
+        for col, value in filters:
+            keep &= data.take(col, chunk) == value
+        found.append(chunk[keep])
+        start += size
+        size *= 2
+    return np.concatenate(found)[:k] if found else labels[:0]
+
+class TopRunsRequest(BaseModel):
+    product_name: str
+    k: int = Field(default=5, ge=1, le=50)
+    line: Optional[int] = None
+    mill: Optional[int] = None
+
+@app.post("/rank_product_top/")
+def rank_product_top(request: TopRunsRequest):
+    """คืน K แถวที่ดีที่สุดที่ผ่าน RFT ของ Product โดยเลือกกรองตาม Line และ/หรือ Mill ได้"""
+    product_name = request.product_name.upper()
+
+    with stage_timer("lookup"):
+        outcome = product_outcome(product_name)
+        labels = best_run_index.runs(product_name)
+    count_outcome("rank_product_top", outcome)
+
+    if outcome == "no_data":
+        raise ProductNotFoundError(product_name)
+
+    if outcome == "no_rft":
+        raise HTTPException(status_code=404, detail="No matching data found for both RFT-ext. and RFT-Mill.")
+
+    if outcome == "no_throughput":
+        return {"warning": "No valid numerical data found in 'Throughput mill (kg/h)' column. Skipping throughput ranking."}
+
+    # labels เรียงตาม Throughput ไว้แล้ว กรองแล้วหยิบ K ตัวแรกได้เลย
+    with stage_timer("filter"):
+        top_labels = first_matching_runs(labels, request.k, request.line, request.mill)
+
+    data = df
+    columns = [col for col in BEST_RUN_COLUMNS if col in data.columns]
+    runs = []
+    with stage_timer("rounding"):
+        for rank, entry in enumerate(data.rows(top_labels, columns).to_dict('records'), start=1):
+            runs.append({"rank": rank, "po": entry['PO'], **build_product_result(entry)})
+
+    return {"product": product_name, "runs": runs}
+
+# คอลัมน์ของไฟล์ export ค่าที่แนะนำ (ชื่อคอลัมน์ใน export: คอลัมน์ใน df)
+EXPORT_COLUMNS = {
+    'Product': 'Product',
+    'PO': 'PO',
+    'Extrude machine no.': 'Line',
+    'Dosing': 'Dosing',
+    'Suggestion Side feed': 'Suggestion Side feed',
+    'HT1': 'HT1', 'HT2': 'HT2', 'HT3': 'HT3', 'HT4': 'HT4', 'HT5': 'HT5',
+    'Screw speed': 'Screw speed',
+    'Torque': 'Torque',
+    'Mill machine no.': 'Mill',
+    'Feed': 'Feed', 'Sep.': 'Sep.', 'Rotor': 'Rotor', 'Air flow': 'Air flow',
+    'Throughput ext.(kg/h)': 'Throughput ext.(kg/h)',
+    'Throughput mill (kg/h)': 'Throughput mill (kg/h)',
+}
+
+def build_recommendations(index, data):
+    """คำนวณค่าที่แนะนำของทุก Product จากแถวที่ดีที่สุดใน index ทีละคอลัมน์ (ผลเหมือน /rank_product/)"""
+    codes, labels = index.best_rows()
+    best = data.rows(labels, [col for col in BEST_RUN_COLUMNS if col in data.columns]).infer_objects()
+    # ค่าใน /rank_product/ เป็น float และ str ของ Python จึงใช้ float64 และ object เหมือนกัน (ไม่ขึ้นกับจำนวน chunk)
+    best = best.astype({col: np.float64 if best[col].dtype == np.float32 else object
+                        for col in best.columns if best[col].dtype == np.float32 or best[col].dtype == 'category'})
+    best.index = codes
+    export = pd.DataFrame(index=best.index)
+    for name, col in EXPORT_COLUMNS.items():
+        values = best[col] if col in best.columns else pd.Series(None, index=best.index, dtype=object)
+        if col in ('Line', 'Mill'):
+            machine = pd.to_numeric(values, errors='coerce')
+            values = np.trunc(machine).astype('Int64').astype(object).where(machine.notna(), 'N/A')
+        elif col in ['HT1', 'HT2', 'HT3', 'HT4', 'HT5', 'Screw speed']:
+            values = round_tens_column(values)
+        elif col == 'Torque':
+            values = round_torque_column(values)
+        elif col in NUMERIC_RESULT_COLUMNS:
+            numeric = pd.to_numeric(values, errors='coerce')
+            values = keep_text(values, numeric, numeric)
+        export[name] = values
+    return export.reset_index(drop=True)
+
+def parquet_bytes(data):
+    # คอลัมน์ที่มีทั้งตัวเลขและข้อความ เก็บเป็นข้อความใน Parquet
+    data = data.copy()
+    for col in data.columns[data.dtypes == object]:
+        data[col] = data[col].map(lambda value: None if pd.isna(value) else str(value))
+    buffer = BytesIO()
+    data.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+EXPORT_FORMATS = {
+    'csv': ("text/csv", lambda data: b"".join(iter_csv(data))),
+    'parquet': ("application/vnd.apache.parquet", parquet_bytes),
+}
+
+# ผล export ของ generation ล่าสุด (คำนวณครั้งเดียวต่อ generation แล้วส่งซ้ำได้ทันที)
+recommendation_export = {"tag": None, "frame": None, "bodies": {}}
+recommendation_export_lock = threading.Lock()
+
+def recommendation_export_body(export_format):
+    with recommendation_export_lock:
+        tag = loaded_state["tag"]
+        if recommendation_export["tag"] != tag:
+            with stage_timer("export_build"):
+                frame = build_recommendations(best_run_index, df)
+            recommendation_export.update(tag=tag, frame=frame, bodies={})
+
+        body = recommendation_export["bodies"].get(export_format)
+        if body is None:
+            with stage_timer("serialization"):
+                body = EXPORT_FORMATS[export_format][1](recommendation_export["frame"])
+            recommendation_export["bodies"][export_format] = body
+    return tag, body
+
+@app.get("/export-recommendations/")
+def export_recommendations(http_request: Request, format: str = 'csv'):
+    """ค่าที่แนะนำของ extrude/mill สำหรับทุก Product ในไฟล์เดียว (CSV หรือ Parquet)"""
+    export_format = format.lower()
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}. Use one of: {', '.join(EXPORT_FORMATS)}")
+
+    etag = f'"{loaded_state["tag"]}-export-{export_format}"'
+    if etag_matches(http_request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    try:
+        tag, body = recommendation_export_body(export_format)
+    except ImportError as e:
+        raise HTTPException(status_code=501, detail=f"Parquet export is not available on this server: {e}")
+
+    media_type = EXPORT_FORMATS[export_format][0]
+    return Response(content=body, media_type=media_type, headers={
+        "ETag": f'"{tag}-export-{export_format}"',
+        "Content-Disposition": f"attachment; filename=recommendations.{export_format}",
+    })
+
+def stats_entry(runs, passed, sketches):
+    return {
+        "runs": runs,
+        "rft_passed": passed,
+        "pass_rate": round(passed / runs, 4) if runs else None,
+        "throughput": {metric: sketches.get(metric, QuantileSketch()).summary() for metric in STATS_METRICS},
+    }
+
+@app.post("/product_stats/")
+def product_stats(request: ProductRequest):
+    """สถิติของ Product: จำนวนที่ผ่าน RFT, pass rate และ min/median/p90/max ของ Throughput แยกตาม Line และ Mill"""
+    product_name = request.product_name.upper()
+    groups = throughput_stats.product(product_name)
+    if groups is None:
+        raise ProductNotFoundError(product_name)
+
+    by_machine = []
+    totals = {metric: QuantileSketch() for metric in STATS_METRICS}
+    runs = passed = 0
+    for (line, mill), entry in sorted(groups.items(), key=lambda item: (item[0][0] is None, item[0][0] or 0, item[0][1] is None, item[0][1] or 0)):
+        sketches = {metric: entry[metric] for metric in STATS_METRICS}
+        by_machine.append({"line": line, "mill": mill, **stats_entry(entry["runs"], entry["rft_passed"], sketches)})
+        runs += entry["runs"]
+        passed += entry["rft_passed"]
+        for metric, sketch in sketches.items():
+            totals[metric] = totals[metric].merge(sketch)
+
+    return {"product": product_name, **stats_entry(runs, passed, totals), "by_line_mill": by_machine}
+
+@app.get("/search_products/")
+def search_products(q: str, limit: int = Query(default=10, ge=1, le=50)):
+    """ค้นหารหัส Product สำหรับ autocomplete: รหัสที่ขึ้นต้นด้วย q และรหัสที่ใกล้เคียง (กรณีพิมพ์ผิด)"""
+    query = q.strip().upper()
+    index = product_code_index
+    prefix = index.prefix(query, limit) if query else []
+    similar = []
+    if query and len(prefix) < limit:
+        matched = set(prefix)
+        similar = [{"code": code, "distance": distance}
+                   for code, distance in index.similar(query, limit) if code not in matched][:limit - len(prefix)]
+    return {"query": query, "prefix": prefix, "similar": similar}
+
+def process_memory():
+    """หน่วยความจำของ process นี้จาก /proc/self/status (Linux) คืน None ถ้าอ่านไม่ได้
+
+    rss_anon_bytes คือหน่วยความจำของ worker นี้เอง rss_file_bytes คือหน้าของไฟล์ที่ map ไว้ (snapshot) ซึ่งใช้ร่วมกับ worker อื่น
+    """
+    try:
+        with open('/proc/self/status', encoding='utf-8') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    fields = {"rss_bytes": "VmRSS", "rss_anon_bytes": "RssAnon", "rss_file_bytes": "RssFile", "peak_rss_bytes": "VmHWM"}
+    return {name: int(status[key].split()[0]) * 1024 for name, key in fields.items() if key in status}
+
+@app.get("/memory-report/")
+def memory_report():
+    """รายงานขนาดหน่วยความจำของ df แยกตามคอลัมน์ และหน่วยความจำของ process
+
+    bytes ของคอลัมน์ที่ map จาก snapshot คือขนาดของไฟล์ (ใช้ร่วมกันทุก worker) ใช้ค่าของ process เทียบการใช้หน่วยความจำจริง
+    """
+    data = df
+    usage = sum(chunk.memory_usage(index=False, deep=True).reindex(data.columns, fill_value=0) for chunk in data.chunks)
+    for col, column in data.text.items():
+        usage[col] += column.nbytes
+    columns = [
+        {"column": col, "dtype": "str" if col in data.text else str(data.chunks[0][col].dtype if col in data.chunks[0].columns else data.chunks[-1][col].dtype),
+         "bytes": int(usage[col])}
+        for col in data.columns
+    ]
+    return {"rows": len(data), "chunks": len(data.chunks), "total_bytes": int(usage.sum()), "columns": columns,
+            "process": process_memory()}
+
 class ProductCode(BaseModel):
     code: str
 
@@ -178,43 +1883,53 @@ class ProductListRequest(BaseModel):
 # เก็บข้อมูล JSON ชั่วคราวด้วย UUID
 json_store = {}
 
-@app.post("/rank_best_process/")
-def rank_best_process(request: ProductListRequest):
-    result = {"product": []}
-
-    for product in request.product:
-        product_name = product.code.upper()
-        logging.debug(f"Processing product name: {product_name}")
+def rank_codes(codes):
+    """จัดอันดับ Product หลายตัวในครั้งเดียวแบบ vectorized คืน DataFrame (code, po, status)"""
+    names = pd.Series(list(codes), dtype=object).str.upper()
+
+    # ค้นหาทุก code ใน index พร้อมกันด้วย searchsorted แล้วอ่าน PO ของแถวที่ดีที่สุดครั้งเดียว
+    known, rft_passed, best = best_run_index.lookup(names.to_numpy(dtype=str))
+    po = pd.Series(None, index=range(len(names)), dtype=object)
+    has_best = best >= 0
+    if has_best.any():
+        labels, positions = np.unique(best[has_best], return_inverse=True)
+        po[has_best] = df.rows(labels, ['PO'])['PO'].to_numpy(dtype=object)[positions]
+
+    status = np.select(
+        [~known, ~rft_passed, po.isna().values],
+        ["no_data", "no_rft", "no_throughput"],
+        default="ok",
+    )
+    return pd.DataFrame({"code": names.values, "po": po.values, "status": status})
 
-        if product_name not in df['Product'].str.upper().values:
+@app.post("/rank_best_process/")
+def rank_best_process(request: ProductListRequest, http_request: Request):
+    codes = [product.code.upper() for product in request.product]
+    return cached_json_response(http_request, ["rank_best_process", codes], lambda: best_process_result(codes))
+
+def best_process_result(codes):
+    with stage_timer("lookup"):
+        ranked = rank_codes(codes)
+    for outcome, count in ranked["status"].value_counts().items():
+        count_outcome("rank_best_process", outcome, int(count))
+
+    # แจ้ง Error และ Warning ราย Product เหมือนเดิม
+    for product_name, status in ranked.loc[ranked["status"] != "ok", ["code", "status"]].itertuples(index=False):
+        if status == "no_data":
             logging.error(f"No data found for product: {product_name}")
-            continue
-
-        product_df = df[df['Product'].str.upper() == product_name].copy()
-
-        # กรองข้อมูลเฉพาะที่มีค่า '/' ใน RFT-ext. และ RFT-Mill
-        filtered_df = product_df[(product_df['RFT-ext.'] == '/') & (product_df['RFT-Mill'] == '/')].copy()
-
-        if filtered_df.empty:
+        elif status == "no_rft":
             logging.error(f"No Data pass RFT for product: {product_name}")
-            continue
-
-        # กรองข้อมูลที่มีค่า Throughput mill (kg/h)
-        filtered_df = filtered_df.dropna(subset=['Throughput mill (kg/h)'])
-
-        if filtered_df.empty:
+        else:
             logging.warning(f"Thoruhtput is error for product: {product_name}")
-            continue
-
-        # เรียงลำดับตาม Throughput mill (kg/h) และเลือกอันที่ดีที่สุด
-        filtered_sorted = filtered_df.sort_values(by='Throughput mill (kg/h)', ascending=False)
-        top_entry = filtered_sorted.iloc[0]
 
-        # ดึง Process order จาก Column 3 (PO)
-        best_process_order = top_entry['PO']
+    # เพิ่มข้อมูลใน JSON ที่จะส่งกลับ
+    passed = ranked[ranked["status"] == "ok"]
+    result = {"product": [{"code": code, "po": po} for code, po in zip(passed["code"], passed["po"])]}
 
-        # เพิ่มข้อมูลใน JSON ที่จะส่งกลับ
-        result["product"].append({"code": product_name, "po": best_process_order})
+    # Product ที่ไม่พบ พร้อมรหัสที่ใกล้เคียง
+    missing = ranked.loc[ranked["status"] == "no_data", "code"].unique()
+    if len(missing):
+        result["not_found"] = [{"code": code, "suggestions": product_code_index.suggest(code)} for code in missing]
 
     return result
 
@@ -230,25 +1945,142 @@ def download_json(json_id: str):
 async def rank_best_process_string(request: Request):
     try:
         request_body = await request.body()
-        request_json = json.loads(request_body.decode('utf-8'))
+        request_json = orjson.loads(request_body)
         product_list_request = ProductListRequest(**request_json)
-        return rank_best_process(product_list_request)
-    except json.JSONDecodeError as e:
+        return rank_best_process(product_list_request, request)
+    except orjson.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON format: {e}")
 
+# จำนวน code ที่จัดอันดับต่อรอบในการ stream (rank_codes ทำงานแบบ vectorized ทีละก้อน)
+STREAM_CHUNK_CODES = int(os.environ.get('STREAM_CHUNK_CODES', '1000'))
+
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+STREAM_MESSAGES = {
+    "no_data": ("error", "No data found for product: {code}"),
+    "no_rft": ("error", "No matching data found for both RFT-ext. and RFT-Mill."),
+    "no_throughput": ("warning", "No valid numerical data found in 'Throughput mill (kg/h)' column."),
+}
+
+def item_code(item):
+    """รับได้ทั้ง "CODE" และ {"code": "CODE"}"""
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict) and isinstance(item.get("code"), str):
+        return item["code"]
+    return None
+
+def iter_ndjson_items(body):
+    """แยก NDJSON ทีละบรรทัด คืน (ลำดับ, code หรือ None, ข้อความ error)"""
+    line_no = 0
+    # อ่านจาก BytesIO ทีละบรรทัด ไม่สร้าง list ของทุกบรรทัดไว้ก่อน
+    for line in BytesIO(body):
+        if not line.strip():
+            continue
+        line_no += 1
+        try:
+            code = item_code(orjson.loads(line))
+        except orjson.JSONDecodeError as e:
+            yield line_no, None, f"Invalid JSON format: {e}"
+            continue
+        yield line_no, code, None if code is not None else "Missing 'code'"
+
+def load_json_items(body):
+    """JSON array ของ code หรือ {"product": [...]} แบบเดียวกับ /rank_best_process/"""
+    try:
+        request_json = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON format: {e}")
+    if isinstance(request_json, dict):
+        request_json = request_json.get("product")
+    if not isinstance(request_json, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array or an object with a 'product' list.")
+    return request_json
+
+def iter_json_items(request_json):
+    for item_no, item in enumerate(request_json, start=1):
+        code = item_code(item)
+        yield item_no, code, None if code is not None else "Missing 'code'"
+
+def iter_ranked_lines(items, chunk_codes=STREAM_CHUNK_CODES):
+    """จัดอันดับทีละ chunk แล้วส่งผลออกเป็น NDJSON หนึ่งบรรทัดต่อ code ทันที"""
+    option = orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY
+    while True:
+        chunk = list(islice(items, chunk_codes))
+        if not chunk:
+            break
+        valid = [(line_no, code) for line_no, code, _ in chunk if code is not None]
+        with stage_timer("lookup"):
+            ranked = rank_codes([code for _, code in valid])
+        for outcome, count in ranked["status"].value_counts().items():
+            count_outcome("rank_best_process_stream", outcome, int(count))
+
+        ranked_rows = iter(zip(ranked["code"], ranked["po"], ranked["status"]))
+        lines = []
+        with stage_timer("serialization"):
+            for line_no, code, problem in chunk:
+                if code is None:
+                    lines.append(orjson.dumps({"line": line_no, "status": "invalid", "error": problem}, option=option))
+                    continue
+                code, po, status = next(ranked_rows)
+                if status == "ok":
+                    entry = {"code": code, "po": po, "status": status}
+                else:
+                    kind, message = STREAM_MESSAGES[status]
+                    entry = {"code": code, "status": status, kind: message.format(code=code)}
+                    if status == "no_data":
+                        entry["suggestions"] = product_code_index.suggest(code)
+                lines.append(orjson.dumps(entry, option=option))
+        yield b"".join(lines)
+
+@app.post("/rank_best_process_stream/")
+async def rank_best_process_stream(request: Request):
+    """จัดอันดับ Product จำนวนมาก รับ NDJSON หรือ JSON array แล้วตอบกลับเป็น NDJSON ทีละบรรทัด"""
+    request_body = await request.body()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in NDJSON_MEDIA_TYPES:
+        items = iter_ndjson_items(request_body)
+    else:
+        # แปลงทั้งเอกสารก่อนเริ่ม stream เพื่อให้ JSON ที่ผิดรูปแบบตอบกลับเป็น 400 ได้
+        items = iter_json_items(load_json_items(request_body))
+    return StreamingResponse(iter_ranked_lines(items), media_type="application/x-ndjson")
+
 # ตัวแปรเพื่อเก็บผลลัพธ์ JSON ranked_data
 ranked_data = None
 
-@app.get("/fetch_external_data/")
-async def fetch_external_data():
-    global ranked_data  # ใช้ตัวแปร global เพื่อเก็บผลลัพธ์ JSON ranked_data
-    url = "http://182.52.113.42:8080/ssa/production/wip_new/extruder_control/fetch_link.php"
-    
+# แหล่งข้อมูล WIP จาก extruder_control
+wip_source_url = os.environ.get('WIP_SOURCE_URL', "http://182.52.113.42:8080/ssa/production/wip_new/extruder_control/fetch_link.php")
+
+# client ที่ใช้ร่วมกันทุก request (keep-alive) แทนการเปิด client ใหม่ทุกครั้ง
+upstream_timeout = httpx.Timeout(float(os.environ.get('WIP_SOURCE_TIMEOUT', '10')), connect=5.0)
+upstream_limits = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60)
+upstream_client = None
+
+# cache ของรายการ code จาก WIP: ใช้ได้ทันทีภายใน TTL และยังส่งค่าเก่าได้อีก STALE วินาทีระหว่างที่โหลดใหม่อยู่เบื้องหลัง
+ranked_data_ttl = float(os.environ.get('RANKED_DATA_TTL', '30'))
+ranked_data_stale = float(os.environ.get('RANKED_DATA_STALE', '300'))
+wip_cache = {"codes": None, "fetched_at": 0.0, "ranked": None, "outcomes": []}
+wip_refresh_task = None
+# เก็บ reference ของ task เบื้องหลังไว้ ไม่ให้ถูก garbage collect ระหว่างทำงาน
+background_refresh_tasks = set()
+
+def get_upstream_client():
+    global upstream_client
+    if upstream_client is None:
+        upstream_client = httpx.AsyncClient(timeout=upstream_timeout, limits=upstream_limits)
+    return upstream_client
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    if upstream_client is not None:
+        await upstream_client.aclose()
+
+async def fetch_wip_codes():
+    """ดึงรายการ Product code ที่อยู่ใน WIP จาก extruder_control"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()  # ตรวจสอบว่าการร้องขอสำเร็จหรือไม่
-            data = response.json()  # แปลงข้อมูลที่ได้เป็น JSON
+        response = await get_upstream_client().get(wip_source_url)
+        response.raise_for_status()  # ตรวจสอบว่าการร้องขอสำเร็จหรือไม่
+        data = response.json()  # แปลงข้อมูลที่ได้เป็น JSON
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=f"HTTP error occurred: {e}")
     except Exception as e:
@@ -258,272 +2090,544 @@ async def fetch_external_data():
     if isinstance(data, str):
         data = json.loads(data)  # แปลงสตริง JSON เป็นออบเจ็กต์ Python
 
-    # แปลงข้อมูลให้อยู่ในรูปแบบ JSON ที่ต้องการ
-    transformed_data = {"product": [{"code": item["code"]} for item in data["product"]]}
+    return [item["code"] for item in data["product"]]
+
+async def refresh_wip_cache():
+    """โหลดรายการ WIP ใหม่ โดยมีการโหลดจาก upstream ได้ครั้งละหนึ่ง request เท่านั้น"""
+    global wip_refresh_task
+
+    async def refresh():
+        codes = await fetch_wip_codes()
+        wip_cache.update(codes=codes, fetched_at=time.monotonic(), ranked=None)
+
+    if wip_refresh_task is None or wip_refresh_task.done():
+        wip_refresh_task = asyncio.create_task(refresh())
+        # ป้องกัน warning กรณีเป็นการโหลดเบื้องหลังที่ไม่มีใครรอผลลัพธ์
+        wip_refresh_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    await asyncio.shield(wip_refresh_task)
+
+def rank_wip_codes():
+    """จัดอันดับรายการ WIP ภายใน process เดียวกัน (ไม่ต้องเรียก /rank_best_process/ ผ่าน HTTP)"""
+    global ranked_data
+    if wip_cache["ranked"] is None:
+        wip_cache["ranked"], wip_cache["outcomes"] = record_outcomes(lambda: best_process_result(wip_cache["codes"]))
+    else:
+        replay_outcomes(wip_cache["outcomes"])
+    ranked_data = wip_cache["ranked"]
+    return ranked_data
 
-    # เรียกใช้ API /rank_best_process/ ด้วยข้อมูลที่แปลงแล้ว
+def invalidate_ranked_data():
+    # ข้อมูล RFT เปลี่ยน ต้องจัดอันดับใหม่ แต่ยังใช้รายการ WIP เดิมได้
+    wip_cache["ranked"] = None
+
+async def background_refresh():
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://web-production-6f0b.up.railway.app/rank_best_process/", json=transformed_data)
-            response.raise_for_status()
-            ranked_data = response.json()
-    except httpx.HTTPStatusError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=f"HTTP error occurred while ranking: {e}")
+        await refresh_wip_cache()
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred while ranking: {e}")
+        logging.warning(f"Background WIP refresh failed: {e}")
 
-    return ranked_data
+@app.get("/fetch_external_data/")
+async def fetch_external_data():
+    await refresh_wip_cache()
+    return rank_wip_codes()
 
 @app.get("/")
 async def get_ranked_data():
-    global ranked_data  # ใช้ตัวแปร global เพื่อเก็บผลลัพธ์ JSON ranked_data
-    ranked_data = await fetch_external_data()  # เรียกใช้ API /fetch_external_data/ เพื่ออัปเดต ranked_data
-    if ranked_data is None:
+    age = time.monotonic() - wip_cache["fetched_at"]
+    if wip_cache["codes"] is None or age >= ranked_data_ttl + ranked_data_stale:
+        await refresh_wip_cache()
+    elif age >= ranked_data_ttl and (wip_refresh_task is None or wip_refresh_task.done()):
+        # ส่งค่าเดิมไปก่อน แล้วโหลดใหม่เบื้องหลัง
+        task = asyncio.create_task(background_refresh())
+        background_refresh_tasks.add(task)
+        task.add_done_callback(background_refresh_tasks.discard)
+
+    if wip_cache["codes"] is None:
         raise HTTPException(status_code=404, detail="No ranked data available. Please fetch external data first.")
-    return ranked_data
-
-
-
-
-@app.post("/upload-parameter/")
-async def upload_parameter(file: UploadFile = File(...), sheet_name: str = 'Sheet1'):
+    return rank_wip_codes()
+
+# การอ่านไฟล์ Excel (openpyxl) ใช้เวลานาน จึงทำใน thread pool แยกเพื่อไม่ให้ event loop ค้าง
+excel_workers = int(os.environ.get('EXCEL_PARSE_WORKERS', '2'))
+excel_timeout = float(os.environ.get('EXCEL_PARSE_TIMEOUT', '120'))
+excel_executor = ThreadPoolExecutor(max_workers=excel_workers, thread_name_prefix='excel-parse')
+# จำกัดจำนวนไฟล์ที่อ่านพร้อมกันด้วย semaphore (หนึ่งตัวต่อ event loop) เพื่อให้ timeout นับเฉพาะเวลาอ่านไฟล์ ไม่รวมเวลารอคิว
+excel_slots = weakref.WeakKeyDictionary()
+
+def excel_slot():
+    loop = asyncio.get_running_loop()
+    slot = excel_slots.get(loop)
+    if slot is None:
+        slot = excel_slots[loop] = asyncio.Semaphore(excel_workers)
+    return slot
+
+# ขนาดของแต่ละ chunk ตอนเขียนไฟล์ที่อัปโหลดลงดิสก์
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def check_excel_filename(file: UploadFile):
     # ตรวจสอบประเภทไฟล์
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(status_code=400, detail="Please upload a valid Excel file with .xlsx or .xls extension")
 
-    # อ่านไฟล์โดยตรงจากไบต์
+async def spool_upload(file: UploadFile):
+    """เขียนไฟล์ที่อัปโหลดลงดิสก์ทีละ chunk แทนการอ่านทั้งไฟล์เข้าหน่วยความจำ คืน path ของไฟล์"""
+    suffix = os.path.splitext(file.filename)[1]
+    with NamedTemporaryFile(delete=False, suffix=suffix) as spooled:
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            remove_file(spooled.name)
+            raise
+    return spooled.name
+
+async def parse_upload(file: UploadFile, cleaner, *args):
+    """เรียก cleaner(path, *args) ใน excel_executor พร้อม timeout แล้วลบไฟล์ชั่วคราวทิ้งเมื่ออ่านเสร็จ"""
+    check_excel_filename(file)
+    path = await spool_upload(file)
+    loop = asyncio.get_running_loop()
+    slot = excel_slot()
     try:
-        contents = await file.read()
-        excel_data = BytesIO(contents)
-        
-        # เลือก engine ตามประเภทไฟล์
-        if file.filename.endswith('.xls'):
-            df = pd.read_excel(excel_data, sheet_name=sheet_name, engine='xlrd')
-        else:
-            df = pd.read_excel(excel_data, sheet_name=sheet_name, engine='openpyxl')
-            
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading the Excel file: {e}")
-
-    # เลือกคอลัมน์ที่ต้องการและเปลี่ยนชื่อ
-    columns_to_keep = {
-        'Batch no.': 'Batch no.',
-        'Process no.': 'PO',
-        'Product code': 'Product',
-        'Line': 'Line',
-        'Mill-1': 'Mill',
-        'Extrusion (Dosing)': 'Dosing',
-        'Extrusion (Side feed)': 'Suggestion Side feed',
-        'HT1 (C)': 'HT1',
-        'HT2 (C)': 'HT2',
-        'HT3 (C)': 'HT3',
-        'HT4 (C)': 'HT4',
-        'HT5 (C)': 'HT5',
-        'Screw speed (rpm)': 'Screw speed',
-        'Torque (%)': 'Torque',
-        'Milling-1 (Feed)': 'Feed',
-        'Milling-1 (Sep.)': 'Sep.',
-        'Milling-1 (Rotor)': 'Rotor',
-        'Milling-1 (Air flow)': 'Air flow'
-    }
-
-    # กรองและเปลี่ยนชื่อคอลัมน์
+        await slot.acquire()
+    except BaseException:
+        remove_file(path)
+        raise
     try:
-        df = df[list(columns_to_keep.keys())]
-        df = df.rename(columns=columns_to_keep)
-    except KeyError as e:
-        raise HTTPException(status_code=400, detail=f"Missing required columns: {e}")
-
-   # ล้างข้อมูลที่ไม่จำเป็นออกจากคอลัมน์ทั้งหมด
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-    
-    uploaded_files_data['parameter'] = df  
-
-# บันทึกไฟล์ CSV ชั่วคราวด้วยการเข้ารหัส 'utf-8-sig'
-    temp_file = NamedTemporaryFile(delete=False, suffix=".csv")
-    df.to_csv(temp_file.name, index=False, encoding='utf-8-sig')
-
-    # ส่งไฟล์ CSV กลับเป็นการตอบกลับ
-    temp_file.seek(0)
-    return StreamingResponse(
-        iter([temp_file.read()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=cleaned_parameter.csv"}
-    )
-
-@app.post("/upload-extrude/")
-async def upload_extrude(file: UploadFile = File(...)):
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Please upload a valid Excel file with .xlsx or .xls extension")
+        future = excel_executor.submit(cleaner, path, *args)
+    except BaseException:
+        slot.release()
+        remove_file(path)
+        raise
+
+    def finished(_):
+        # thread ที่อ่านไฟล์ยังทำงานต่อแม้ request จะ timeout ไปแล้ว จึงลบไฟล์และคืน slot เมื่ออ่านจบจริงเท่านั้น
+        remove_file(path)
+        try:
+            loop.call_soon_threadsafe(slot.release)
+        except RuntimeError:
+            pass  # event loop ปิดไปแล้ว
+
+    future.add_done_callback(finished)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=excel_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Timed out after {excel_timeout:g}s while reading the Excel file")
+
+# การ clean ข้อมูลของแต่ละไฟล์ที่อัปโหลด กำหนดแบบ declarative แล้วประมวลผลทีละคอลัมน์ (vectorized)
+#   read:       ตัวเลือกของ pd.read_excel (header, sheet_name)
+#   columns:    คอลัมน์ที่ต้องการ และชื่อใหม่
+#   numeric:    คอลัมน์ที่ต้องเป็นตัวเลข (ค่าที่แปลงไม่ได้จะเป็น NaN)
+#   max:        ลบแถวที่มีค่าเกินกำหนด (หรือไม่มีค่า)
+#   strip:      ตัดช่องว่างหน้า/หลังของข้อความในทุกคอลัมน์
+#   flags:      คอลัมน์ RFT ที่ได้ '/' เมื่อไม่มีค่า และ '' เมื่อมีค่า (ไม่มี defect)
+#   drop_empty: ลบแถวที่คอลัมน์นั้นเป็นข้อความว่าง
+UPLOAD_SCHEMAS = {
+    'parameter': {
+        'read': {'header': 0},
+        'columns': {
+            'Batch no.': 'Batch no.',
+            'Process no.': 'PO',
+            'Product code': 'Product',
+            'Line': 'Line',
+            'Mill-1': 'Mill',
+            'Extrusion (Dosing)': 'Dosing',
+            'Extrusion (Side feed)': 'Suggestion Side feed',
+            'HT1 (C)': 'HT1',
+            'HT2 (C)': 'HT2',
+            'HT3 (C)': 'HT3',
+            'HT4 (C)': 'HT4',
+            'HT5 (C)': 'HT5',
+            'Screw speed (rpm)': 'Screw speed',
+            'Torque (%)': 'Torque',
+            'Milling-1 (Feed)': 'Feed',
+            'Milling-1 (Sep.)': 'Sep.',
+            'Milling-1 (Rotor)': 'Rotor',
+            'Milling-1 (Air flow)': 'Air flow'
+        },
+        'strip': True,
+    },
+    'extrude': {
+        'read': {'header': 2},  # ใช้ row ที่ 3 เป็น header
+        'columns': {'ProcessOrderId': 'PO', 'ActualThroughput_AvgWeighted': 'Throughput ext.(kg/h)'},
+        'numeric': ['Throughput ext.(kg/h)'],
+        'max': {'Throughput ext.(kg/h)': 2000},
+        'strip': True,
+    },
+    'mill': {
+        'read': {'header': 2},  # ใช้ row ที่ 3 เป็น header
+        'columns': {'ProcessOrderId': 'PO', 'ActualThroughput_AvgWeighted': 'Throughput mill (kg/h)'},
+        'numeric': ['Throughput mill (kg/h)'],
+        'max': {'Throughput mill (kg/h)': 2000},
+        'strip': True,
+    },
+    'qapd': {
+        'read': {'sheet_name': 'Data 2023-2024', 'header': 0},
+        'columns': {'Work Order no.': 'PO', 'Granule': 'RFT-ext.', 'Defect (NCR)': 'RFT-Mill'},
+        'flags': ['RFT-ext.', 'RFT-Mill'],
+        'drop_empty': ['PO'],
+    },
+}
 
+def read_excel_file(path, **options):
     try:
-        contents = await file.read()
-        excel_data = BytesIO(contents)
-        df = pd.read_excel(excel_data, header=2)  # ใช้ row ที่ 3 เป็น header
+        # เลือก engine ตามประเภทไฟล์
+        engine = 'xlrd' if path.endswith('.xls') else 'openpyxl'
+        with stage_timer("excel_parse"):
+            return pd.read_excel(path, engine=engine, **options)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error reading the Excel file: {e}")
 
-    # เลือกคอลัมน์ที่ต้องการและเปลี่ยนชื่อ
-    df_cleaned = df[['ProcessOrderId', 'ActualThroughput_AvgWeighted']]
-    df_cleaned.columns = ['PO', 'Throughput ext.(kg/h)']
-
-    # ลบแถวที่มีค่า Throughput ext.(kg/h) เกิน 2000
-    df_cleaned = df_cleaned[df_cleaned['Throughput ext.(kg/h)'] <= 2000]
+def clean_frame(df, schema):
+    """clean DataFrame ตาม schema คืน (DataFrame, summary ที่มีจำนวนแถวที่ถูกตัดออกแยกตามเงื่อนไข)"""
+    columns = schema['columns']
 
-    # ล้างข้อมูลที่ไม่จำเป็นออกจากคอลัมน์
-    df_cleaned = df_cleaned.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    # เลือกคอลัมน์ที่ต้องการและเปลี่ยนชื่อ
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing required columns: {missing}")
+    df = df[list(columns)].rename(columns=columns)
+
+    summary = {"rows_in": len(df), "rejected": {}}
+    keep = np.ones(len(df), dtype=bool)
+
+    for col in schema.get('numeric', []):
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    # ลบแถวที่มีค่าเกินกำหนด (เช่น Throughput เกิน 2000)
+    for col, limit in schema.get('max', {}).items():
+        within = (df[col] <= limit).to_numpy()
+        summary["rejected"][f"{col} > {limit}"] = int((keep & ~within).sum())
+        keep &= within
+
+    # ล้างข้อมูลที่ไม่จำเป็นออกจากคอลัมน์ (เฉพาะค่าที่เป็นข้อความ)
+    if schema.get('strip'):
+        for col in df.columns:
+            if df[col].dtype == object:
+                # คอลัมน์ object อาจมีค่าที่ไม่ใช่ข้อความ (เช่น เวลา ตัวเลข bool หรือว่างทั้งคอลัมน์) ตัดช่องว่างเฉพาะ str
+                df[col] = df[col].map(lambda value: value.strip() if isinstance(value, str) else value)
+
+    # ประมวลผลข้อมูลตามเงื่อนไข: ไม่มีค่า (ไม่มี defect) = ผ่าน RFT
+    for col in schema.get('flags', []):
+        df[col] = np.where(df[col].notna(), '', '/')
+
+    # ลบ Rows ที่มีค่าเป็นค่าว่าง
+    for col in schema.get('drop_empty', []):
+        present = (df[col] != '').to_numpy()
+        summary["rejected"][f"empty {col}"] = int((keep & ~present).sum())
+        keep &= present
+
+    df = df[keep]
+    summary["rows_out"] = len(df)
+    return df, summary
+
+# เปลี่ยนค่านี้เมื่อแก้ logic ของ clean_frame เพื่อไม่ให้ใช้ผลใน cache ที่ clean ด้วย logic เก่า
+UPLOAD_CACHE_VERSION = 1
+
+def upload_cache_key(path, source, options):
+    """hash ของเนื้อไฟล์ + source + ตัวเลือกการอ่าน (รวม sheet) + schema ที่ใช้ clean"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    schema = {key: value for key, value in UPLOAD_SCHEMAS[source].items() if key != 'read'}
+    digest.update(repr((UPLOAD_CACHE_VERSION, source, sorted(options.items()), schema)).encode('utf-8'))
+    return digest.hexdigest()
+
+def clean_upload(path, source, sheet_name=None):
+    schema = UPLOAD_SCHEMAS[source]
+    options = dict(schema['read'])
+    if sheet_name is not None:
+        options['sheet_name'] = sheet_name
+
+    key = upload_cache_key(path, source, options)
+    cached = upload_cache.get(key)
+    increment("rft_upload_cache_total", {"result": "miss" if cached is None else "hit"})
+    if cached is not None:
+        return cached
+
+    data = read_excel_file(path, **options)
+    with stage_timer("clean"):
+        result = clean_frame(data, schema)
+    upload_cache.put(key, result)
+    return result
 
-    uploaded_files_data['extrude'] = df_cleaned
+# จำนวนแถวต่อ chunk ตอนส่ง CSV กลับ
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '5000'))
 
-    # บันทึกไฟล์ CSV ชั่วคราว
-    temp_file = NamedTemporaryFile(delete=False, suffix=".csv")
-    df_cleaned.to_csv(temp_file.name, index=False, encoding='utf-8-sig')
+def iter_csv(data, chunk_rows=CSV_CHUNK_ROWS):
+    """แปลง DataFrame เป็น CSV แบบ utf-8-sig ทีละ chunk (ไม่ต้องเขียนไฟล์ลงดิสก์)"""
+    yield '\ufeff'.encode('utf-8')
+    for start in range(0, max(len(data), 1), chunk_rows):
+        with stage_timer("csv_write"):
+            chunk = data.iloc[start:start + chunk_rows].to_csv(index=False, header=(start == 0)).encode('utf-8')
+        yield chunk
 
-    # ส่งไฟล์ CSV กลับเป็นการตอบกลับ
-    temp_file.seek(0)
+def csv_response(data, filename):
+    # ส่งไฟล์ CSV กลับเป็นการตอบกลับแบบ stream
     return StreamingResponse(
-        iter([temp_file.read()]),
+        iter_csv(data),
         media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=cleaned_extrude.csv"}
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
-@app.post("/upload-mill/")
-async def upload_mill(file: UploadFile = File(...)):
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Please upload a valid Excel file with .xlsx or .xls extension")
-
-    try:
-        contents = await file.read()
-        excel_data = BytesIO(contents)
-        df = pd.read_excel(excel_data, header=2)  # ใช้ row ที่ 3 เป็น header
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading the Excel file: {e}")
-
-    # เลือกคอลัมน์ที่ต้องการและเปลี่ยนชื่อ
-    df_cleaned = df[['ProcessOrderId', 'ActualThroughput_AvgWeighted']]
-    df_cleaned.columns = ['PO', 'Throughput mill (kg/h)']
+def cleaned_csv_response(source, df, summary):
+    # เก็บข้อมูลที่ clean แล้ว และส่งจำนวนแถวที่ถูกตัดออกกลับไปใน header
+    uploaded_files_data[source] = df
+    response = csv_response(df, f"cleaned_{source}.csv")
+    response.headers["X-Clean-Summary"] = json.dumps(summary, separators=(',', ':'), ensure_ascii=False)
+    return response
 
-    # ลบแถวที่มีค่า Throughput mill (kg/h) เกิน 2000
-    df_cleaned = df_cleaned[df_cleaned['Throughput mill (kg/h)'] <= 2000]
+@app.post("/upload-parameter/")
+async def upload_parameter(file: UploadFile = File(...), sheet_name: str = 'Sheet1'):
+    df, summary = await parse_upload(file, clean_upload, 'parameter', sheet_name)
+    return cleaned_csv_response('parameter', df, summary)
 
-    # ล้างข้อมูลที่ไม่จำเป็นออกจากคอลัมน์
-    df_cleaned = df_cleaned.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-    uploaded_files_data['mill'] = df_cleaned
-    # บันทึกไฟล์ CSV ชั่วคราว
-    temp_file = NamedTemporaryFile(delete=False, suffix=".csv")
-    df_cleaned.to_csv(temp_file.name, index=False, encoding='utf-8-sig')
+@app.post("/upload-extrude/")
+async def upload_extrude(file: UploadFile = File(...)):
+    df_cleaned, summary = await parse_upload(file, clean_upload, 'extrude')
+    return cleaned_csv_response('extrude', df_cleaned, summary)
 
-    # ส่งไฟล์ CSV กลับเป็นการตอบกลับ
-    temp_file.seek(0)
-    return StreamingResponse(
-        iter([temp_file.read()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=cleaned_mill.csv"}
-    )
+@app.post("/upload-mill/")
+async def upload_mill(file: UploadFile = File(...)):
+    df_cleaned, summary = await parse_upload(file, clean_upload, 'mill')
+    return cleaned_csv_response('mill', df_cleaned, summary)
 
 @app.post("/upload-qapd/")
 async def upload_qapd(file: UploadFile = File(...)):
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Please upload a valid Excel file with .xlsx or .xls extension")
-
-    try:
-        contents = await file.read()
-        excel_data = BytesIO(contents)
-        # อ่านข้อมูลจากชีทที่ชื่อว่า 'Data 2023-2024'
-        df = pd.read_excel(excel_data, sheet_name='Data 2023-2024', header=0)  # ใช้ row แรกเป็น header
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading the Excel file: {e}")
+    df_cleaned, summary = await parse_upload(file, clean_upload, 'qapd')
+    return cleaned_csv_response('qapd', df_cleaned, summary)
 
-    # เลือกคอลัมน์ที่ต้องการ
-    df_cleaned = df[['Work Order no.', 'Granule', 'Defect (NCR)']]
+def timed_combine_sources(parameter, sources):
+    with stage_timer("merge"):
+        return combine_sources(parameter, sources)
 
-    # ประมวลผลข้อมูลตามเงื่อนไข
-    df_cleaned['Granule'] = df_cleaned['Granule'].apply(lambda x: '' if pd.notnull(x) else '/')
-    df_cleaned['Defect (NCR)'] = df_cleaned['Defect (NCR)'].apply(lambda x: '' if pd.notnull(x) else '/')
+def combine_sources(parameter, sources):
+    """รวม parameter กับแต่ละ source ด้วย PO แบบ hash join ครั้งเดียว
 
-    # เปลี่ยนชื่อคอลัมน์
-    df_cleaned.columns = ['PO', 'RFT-ext.', 'RFT-Mill']
+    ลบ PO ซ้ำของแต่ละ source ก่อน join (เก็บแถวแรก) จึงได้ผลเหมือน merge แบบ left แล้ว drop_duplicates
+    แต่ขนาดข้อมูลระหว่างทางไม่เพิ่มขึ้นแบบทวีคูณเมื่อ PO ซ้ำ คืน (DataFrame, summary ของแต่ละ source)
+    """
+    combined = parameter.drop_duplicates(subset=['PO']).reset_index(drop=True)
+    summary = {"parameter": {"rows": len(parameter), "duplicates": len(parameter) - len(combined)}}
 
-    # ลบ Rows ที่มีค่า PO เป็นค่าว่าง
-    df_cleaned = df_cleaned[df_cleaned['PO'] != '']
+    for name, frame in sources.items():
+        unique = frame.drop_duplicates(subset=['PO'])
+        lookup = unique.set_index('PO')
+        positions = lookup.index.get_indexer(combined['PO'])
+        matched = int((positions >= 0).sum())
 
-    uploaded_files_data['qapd'] = df_cleaned
+        joined = lookup.reindex(combined['PO'])
+        for col in lookup.columns:
+            combined[col] = joined[col].to_numpy()
 
-    # บันทึกไฟล์ CSV ชั่วคราว
-    temp_file = NamedTemporaryFile(delete=False, suffix=".csv")
-    df_cleaned.to_csv(temp_file.name, index=False, encoding='utf-8-sig')
+        summary[name] = {
+            "rows": len(frame),
+            "duplicates": len(frame) - len(unique),
+            "matched": matched,
+            "missed": len(combined) - matched,
+        }
 
-    # ส่งไฟล์ CSV กลับเป็นการตอบกลับ
-    temp_file.seek(0)
-    return StreamingResponse(
-        iter([temp_file.read()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=cleaned_qapd.csv"}
-    )
+    return combined, summary
 
 @app.post("/combine-files/")
 async def combine_files():
-    # ตรวจสอบว่าไฟล์ทั้งหมดถูกอัปโหลดและคลีนแล้ว
-    if not all(key in uploaded_files_data and uploaded_files_data[key] is not None for key in ['parameter', 'extrude', 'mill', 'qapd']):
-        raise HTTPException(status_code=400, detail="All files (parameter, extrude, mill, qapd) must be uploaded and cleaned first.")
-
-    # ดึงข้อมูลจาก dict
+    # ดึงข้อมูลจาก uploaded_files_data
     df_parameter = uploaded_files_data['parameter']
     df_extrude = uploaded_files_data['extrude']
     df_mill = uploaded_files_data['mill']
     df_qapd = uploaded_files_data['qapd']
 
-    # รวมข้อมูลโดยใช้คอลัมน์ PO เป็นหลัก
-    combined_df = df_parameter.copy()
-    combined_df = combined_df.merge(df_extrude, on='PO', how='left')
-    combined_df = combined_df.merge(df_mill, on='PO', how='left')
-    combined_df = combined_df.merge(df_qapd, on='PO', how='left')
+    # ตรวจสอบว่าไฟล์ทั้งหมดถูกอัปโหลดและคลีนแล้ว
+    if any(data is None for data in [df_parameter, df_extrude, df_mill, df_qapd]):
+        raise HTTPException(status_code=400, detail="All files (parameter, extrude, mill, qapd) must be uploaded and cleaned first.")
 
-    # ลบข้อมูลซ้ำ
-    combined_df = combined_df.drop_duplicates(subset=['PO'])
+    # รวมข้อมูลโดยใช้คอลัมน์ PO เป็นหลัก
+    # การรวมข้อมูลขนาดใหญ่ใช้เวลานาน จึงทำใน threadpool เพื่อไม่ให้ event loop ค้าง
+    combined_df, summary = await run_in_threadpool(
+        timed_combine_sources, df_parameter, {'extrude': df_extrude, 'mill': df_mill, 'qapd': df_qapd})
+    logging.info(f"Combine summary: {summary}")
 
     # เก็บข้อมูล combined_data ใน uploaded_files_data
     uploaded_files_data['combined_data'] = combined_df
 
-    # บันทึกไฟล์ CSV ชั่วคราว
-    temp_file = NamedTemporaryFile(delete=False, suffix=".csv")
-    combined_df.to_csv(temp_file.name, index=False, encoding='utf-8-sig')
-
-    # ส่งไฟล์ CSV กลับเป็นการตอบกลับ
-    temp_file.seek(0)
-    return StreamingResponse(
-        iter([temp_file.read()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=combined_data.csv"}
-    )
+    response = csv_response(combined_df, "combined_data.csv")
+    response.headers["X-Combine-Summary"] = json.dumps(summary, separators=(',', ':'))
+    return response
 
 @app.post("/append-combined-data/")
-async def append_combined_data():
+async def append_combined_data(background_tasks: BackgroundTasks):
     # ตรวจสอบว่ามีข้อมูล combined_data ใน uploaded_files_data หรือไม่
-    if 'combined_data' not in uploaded_files_data or uploaded_files_data['combined_data'] is None:
+    combined_data = uploaded_files_data['combined_data']
+    if combined_data is None:
         raise HTTPException(status_code=400, detail="ไม่พบข้อมูล combined data กรุณารวมไฟล์ก่อน.")
     try:
-        # ใช้ข้อมูล combined_data จาก uploaded_files_data
-        combined_data = uploaded_files_data['combined_data']
-        # อ่านข้อมูลจากไฟล์ RFT 2024.csv
-        rft_file_path = 'RFT 2024.csv'
+        rft_file_path = file_path
         if not os.path.exists(rft_file_path):
             raise HTTPException(status_code=404, detail="ไม่พบไฟล์ RFT 2024.csv บนเซิร์ฟเวอร์.")
-        
-        rft_data = pd.read_csv(rft_file_path)
-        # รวมข้อมูลจากทั้งสองไฟล์
-        combined_df = pd.concat([rft_data, combined_data], ignore_index=True)
-        # บันทึกข้อมูลที่รวมแล้วเป็นไฟล์ RFT 2024.csv
-        combined_df.to_csv(rft_file_path, index=False, encoding='utf-8-sig')
-        
-        # โหลดไฟล์ CSV และอ่านใหม่อีกครั้ง
-        global df
-        df = pd.read_csv(rft_file_path)
-        
-        # ตรวจสอบว่าข้อมูลถูกโหลดใหม่หรือไม่
-        logging.debug(f"Updated DataFrame: {df.head()}")
-        
-        return {"detail": "เพิ่มข้อมูลลงใน RFT 2024.csv และโหลดใหม่เรียบร้อยแล้ว."}
+
+        new_rows, segment_count = await run_in_threadpool(append_rows, combined_data)
+
+        # รวม segment อัตโนมัติเมื่อมีจำนวนเกินที่กำหนด
+        if segment_count >= max_segments:
+            background_tasks.add_task(compact_rft_data)
+
+        return {"detail": "เพิ่มข้อมูลลงใน RFT 2024.csv และโหลดใหม่เรียบร้อยแล้ว.", "rows": new_rows, "segments": segment_count}
+    except Exception as e:
+        logging.error(f"Error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดขณะประมวลผลไฟล์: {e}")
+
+def append_rows(combined_data):
+    """เขียนข้อมูลชุดใหม่เป็น segment และต่อเข้ากับ df คืน (จำนวนแถว, จำนวน segment)"""
+    global df
+    # ถ้าข้อมูลถูก compact ให้โหลดใหม่นอกล็อกก่อน
+    reload_storage()
+    with storage_lock():
+        # โหลดสิ่งที่ worker อื่นเพิ่มไว้ก่อน เพื่อให้ df ตรงกับข้อมูลบนดิสก์
+        sync_with_storage()
+
+        # เขียนเฉพาะข้อมูลชุดใหม่เป็น segment แทนการเขียน RFT 2024.csv ใหม่ทั้งไฟล์
+        os.makedirs(segment_dir, exist_ok=True)
+        segment_path = os.path.join(segment_dir, f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.csv")
+        combined_data.to_csv(segment_path, index=False, encoding='utf-8-sig')
+
+        # ต่อข้อมูลใหม่เข้ากับ df ในหน่วยความจำ แล้วอัปเดต index เฉพาะแถวใหม่
+        df, new_rows = df.append(combined_data)
+        extend_indexes(new_rows)
+        invalidate_ranked_data()
+
+        set_loaded_state(generation=bump_generation(), segments=loaded_state["segments"] | {segment_path})
+        segment_count = len(loaded_state["segments"])
+
+    logging.debug("Appended %d rows as segment %s", len(new_rows), segment_path)
+    return len(new_rows), segment_count
+
+INGEST_SOURCES = ('parameter', 'extrude', 'mill', 'qapd')
+
+@app.post("/ingest/")
+async def ingest(
+    background_tasks: BackgroundTasks,
+    parameter: UploadFile = File(...),
+    extrude: UploadFile = File(...),
+    mill: UploadFile = File(...),
+    qapd: UploadFile = File(...),
+    sheet_name: str = 'Sheet1',
+):
+    """อัปโหลดทั้ง 4 ไฟล์ใน request เดียว: clean พร้อมกันใน excel_executor แล้วรวมและเพิ่มลงข้อมูล RFT
+
+    ข้อมูลระหว่างทางเก็บในตัวแปรของ job นี้เท่านั้น (ไม่ใช้ uploaded_files_data) จึงอัปโหลดพร้อมกันหลายคนได้
+    """
+    job_id = str(uuid.uuid4())
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="ไม่พบไฟล์ RFT 2024.csv บนเซิร์ฟเวอร์.")
+
+    started = time.perf_counter()
+    files = {'parameter': parameter, 'extrude': extrude, 'mill': mill, 'qapd': qapd}
+    args = {'parameter': (sheet_name,)}
+    results = await asyncio.gather(
+        *(parse_upload(files[source], clean_upload, source, *args.get(source, ())) for source in INGEST_SOURCES),
+        return_exceptions=True,
+    )
+
+    # รายงานข้อผิดพลาดของทุกไฟล์พร้อมกัน แทนการหยุดที่ไฟล์แรก
+    errors = {}
+    for source, result in zip(INGEST_SOURCES, results):
+        if isinstance(result, HTTPException):
+            errors[source] = result.detail
+        elif isinstance(result, Exception):
+            raise result
+    if errors:
+        logging.error("Ingest %s failed: %s", job_id, errors)
+        raise HTTPException(status_code=400, detail={"job_id": job_id, "errors": errors})
+
+    frames = {source: frame for source, (frame, _) in zip(INGEST_SOURCES, results)}
+    clean_summary = {source: summary for source, (_, summary) in zip(INGEST_SOURCES, results)}
+    parsed = time.perf_counter()
+
+    combined_df, combine_summary = await run_in_threadpool(timed_combine_sources, frames.pop('parameter'), frames)
+    del frames
+
+    try:
+        new_rows, segment_count = await run_in_threadpool(append_rows, combined_df)
     except Exception as e:
         logging.error(f"Error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดขณะประมวลผลไฟล์: {e}")
+
+    if segment_count >= max_segments:
+        background_tasks.add_task(compact_rft_data)
+
+    logging.info("Ingest %s appended %d rows", job_id, new_rows)
+    return {
+        "job_id": job_id,
+        "rows": new_rows,
+        "segments": segment_count,
+        "clean": clean_summary,
+        "combine": combine_summary,
+        "timings": {
+            "parse_seconds": round(parsed - started, 3),
+            "total_seconds": round(time.perf_counter() - started, 3),
+        },
+    }
+
+def compact_rft_data():
+    """รวม segment ทั้งหมดเข้า RFT 2024.csv แล้วลบ segment ที่รวมแล้ว
+
+    เขียน CSV และ snapshot จากข้อมูลในหน่วยความจำลงไฟล์ชั่วคราวโดยไม่ถือ storage_lock ถือล็อกเฉพาะตอนตรวจว่าไม่มีการ
+    compact ซ้อน แล้วแทนที่ไฟล์และลบ segment ซึ่ง worker อื่นยัง append ได้ระหว่างเขียน (segment ใหม่จะยังไม่ถูกรวม)
+    """
+    reload_storage()
+    with storage_lock():
+        sync_with_storage()
+        segments = sorted(loaded_state["segments"])
+        data, base = df, loaded_state["base"]
+    if not segments:
+        return 0
+
+    temp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.compact"
+    schema = None
+    try:
+        frame = data.frame()
+        to_csv_frame(frame).to_csv(temp_path, index=False, encoding='utf-8-sig')
+        # fingerprint ของไฟล์ชั่วคราวคงเดิมหลัง os.replace จึงใช้เป็น source ของ snapshot ได้
+        schema = write_snapshot_files(frame, temp_path, folded=[os.path.basename(path) for path in segments])
+        del frame
+
+        with storage_lock():
+            if source_fingerprint(file_path) != base or not set(segments).issubset(list_segments()):
+                logging.info("RFT data was compacted by another worker, discarding this compaction")
+                return 0
+            # โหลด segment ที่ worker อื่น append ระหว่างเขียนก่อนเพิ่ม generation (segment เหล่านั้นยังไม่ถูกรวม)
+            sync_with_storage()
+            # schema.json (ซึ่งบันทึก segment ที่รวมแล้ว) ต้องแทนที่ก่อน RFT 2024.csv ถ้า process หยุดหลังแทนที่ไฟล์
+            # แต่ก่อนลบ segment ครบ ตอนเริ่มใหม่จะข้าม segment เหล่านั้น ไม่เพิ่มแถวซ้ำ
+            publish_snapshot(schema)
+            schema = None
+            os.replace(temp_path, file_path)
+            for path in segments:
+                os.remove(path)
+            set_loaded_state(generation=bump_generation(), base=source_fingerprint(file_path),
+                             segments=loaded_state["segments"] - set(segments))
+    finally:
+        remove_file(temp_path)
+        if schema is not None:
+            discard_snapshot_files(schema)
+
+    logging.info("Compacted %d segments into %s", len(segments), file_path)
+    # โหลด snapshot ใหม่ (นอกล็อก) แทนข้อมูลในหน่วยความจำที่ต่อกันไว้
+    reload_storage(force=True)
+    return len(segments)
+
+@app.post("/compact-rft-data/")
+def compact_rft_data_endpoint():
+    try:
+        compacted = compact_rft_data()
+    except Exception as e:
+        logging.error(f"Error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดขณะรวมไฟล์: {e}")
+    return {"detail": "รวมข้อมูลเข้า RFT 2024.csv เรียบร้อยแล้ว.", "segments": compacted}
+
+if __name__ == '__main__':
+    # ขั้นตอน build/release: python main.py build-snapshot (ไม่ทำอะไรถ้า snapshot ตรงกับ RFT 2024.csv อยู่แล้ว)
+    import sys
+    if sys.argv[1:] != ['build-snapshot']:
+        sys.exit("usage: python main.py build-snapshot")
+    logging.info("RFT snapshot %s", "built" if build_snapshot() else "is up to date")
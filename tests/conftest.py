@@ -0,0 +1,25 @@
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main โหลดข้อมูลและสร้างไฟล์ตอน import จึงต้องชี้ทุก path ไปที่โฟลเดอร์ชั่วคราวก่อน import
+# (ใช้สำเนาของ RFT 2024.csv เพราะการ compact จะเขียนไฟล์นี้ใหม่)
+workdir = tempfile.mkdtemp(prefix='rft-tests-')
+shutil.copy(os.path.join(ROOT, 'RFT 2024.csv'), workdir)
+os.environ.update({
+    'RFT_DATA_FILE': os.path.join(workdir, 'RFT 2024.csv'),
+    'RFT_SNAPSHOT_DIR': os.path.join(workdir, 'rft_snapshot'),
+    'RFT_SEGMENT_DIR': os.path.join(workdir, 'rft_segments'),
+    'RFT_LOCK_FILE': os.path.join(workdir, 'rft_storage.lock'),
+    'RFT_GENERATION_FILE': os.path.join(workdir, 'rft_generation'),
+    'UPLOAD_STAGING_DIR': os.path.join(workdir, 'upload_staging'),
+    'UPLOAD_CACHE_DIR': os.path.join(workdir, 'upload_cache'),
+})
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(workdir, ignore_errors=True)
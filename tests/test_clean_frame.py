@@ -0,0 +1,25 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import main
+
+
+def test_strip_keeps_non_string_cells():
+    raw = pd.DataFrame({
+        'ProcessOrderId': [' PO1 ', 1002, None, True],
+        'ActualThroughput_AvgWeighted': [100, ' 200 ', np.nan, 300],
+        'Note': [datetime.time(8, 30), None, None, None],
+    })
+    # คอลัมน์ object ที่ไม่มีข้อความเลย
+    raw['Empty'] = pd.Series([None] * len(raw), dtype=object)
+    schema = {**main.UPLOAD_SCHEMAS['extrude'],
+              'columns': {**main.UPLOAD_SCHEMAS['extrude']['columns'], 'Note': 'Note', 'Empty': 'Empty'}}
+
+    cleaned, summary = main.clean_frame(raw, schema)
+
+    assert cleaned['PO'].tolist() == ['PO1', 1002, True]
+    assert cleaned['Throughput ext.(kg/h)'].tolist() == [100, 200, 300]
+    assert cleaned['Note'].tolist() == [datetime.time(8, 30), None, None]
+    assert summary['rows_out'] == 3
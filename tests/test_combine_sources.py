@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def random_source(rng, pos, column):
+    rows = rng.integers(0, 40)
+    return pd.DataFrame({'PO': rng.choice(pos, rows), column: rng.normal(500, 100, rows).round(2)})
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_combine_matches_chained_left_merges(seed):
+    rng = np.random.default_rng(seed)
+    # PO ซ้ำกันและบาง PO ไม่มีในบาง source
+    pos = [f"PO{i}" for i in range(30)]
+    parameter = pd.DataFrame({'PO': rng.choice(pos, 50), 'Product': rng.choice(['A', 'B', 'C'], 50)})
+    sources = {
+        'extrude': random_source(rng, pos, 'Throughput ext.(kg/h)'),
+        'mill': random_source(rng, pos, 'Throughput mill (kg/h)'),
+        'qapd': pd.DataFrame({'PO': rng.choice(pos, 25), 'RFT-ext.': rng.choice(['', '/'], 25),
+                              'RFT-Mill': rng.choice(['', '/'], 25)}),
+    }
+
+    expected = parameter.copy()
+    for frame in sources.values():
+        expected = expected.merge(frame, on='PO', how='left')
+    expected = expected.drop_duplicates(subset=['PO']).reset_index(drop=True)
+
+    combined, summary = main.combine_sources(parameter, sources)
+
+    pd.testing.assert_frame_equal(combined, expected, check_dtype=False)
+    assert summary['parameter']['rows'] == len(parameter)
+    for name, frame in sources.items():
+        assert summary[name]['matched'] == int(combined['PO'].isin(frame['PO']).sum())
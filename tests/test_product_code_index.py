@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+import main
+
+
+def random_codes(rng, count):
+    letters = np.array(list('ABCDEFGHJKLMNPRSTUVWXYZ0123456789'))
+    return {''.join(rng.choice(letters, rng.integers(4, 10))) for _ in range(count)}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_with_codes_matches_rebuild(monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    existing = random_codes(rng, 400)
+    batches = [random_codes(rng, 30) - existing for _ in range(4)]
+
+    index = main.ProductCodeIndex(existing)
+    for batch in batches:
+        index = index.with_codes(batch)
+    rebuilt = main.ProductCodeIndex(existing.union(*batches))
+
+    queries = sorted(rng.choice(sorted(rebuilt.codes.tolist()), 40).tolist())
+    # รหัสที่พิมพ์ผิด (ตัดหรือเปลี่ยนตัวอักษร) และ prefix
+    queries += [code[1:] for code in queries[:10]] + [code[:-1] + 'Q' for code in queries[10:20]] + ['A', 'Z9', '']
+    for query in queries:
+        monkeypatch.setattr(main, "product_code_index", index)
+        incremental = main.search_products(query, limit=10)
+        monkeypatch.setattr(main, "product_code_index", rebuilt)
+        assert incremental == main.search_products(query, limit=10)
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def assert_index_matches_rebuild():
+    expected = main.build_best_run_index(main.df.frame())
+    index = main.best_run_index
+    np.testing.assert_array_equal(index.product_codes(), expected.codes)
+    for code in expected.codes:
+        rft, labels = index.entry(code)
+        expected_rft, expected_labels = expected.entry(code)
+        assert rft == expected_rft
+        np.testing.assert_array_equal(labels, expected_labels)
+    for actual, wanted in zip(index.best_rows(), expected.best_rows()):
+        np.testing.assert_array_equal(actual, wanted)
+
+
+def rankings():
+    results = {}
+    for code in main.best_run_index.best_rows()[0]:
+        top = main.rank_product_top(main.TopRunsRequest(product_name=code, k=5))
+        results[code] = (main.product_result(code), [{key: value for key, value in run.items() if key != 'rank'}
+                                                      for run in top["runs"]])
+    return results
+
+
+def new_batch(seed, rows=200):
+    source = pd.read_csv(main.file_path)
+    batch = source.sample(rows, random_state=seed).reset_index(drop=True)
+    # ให้บาง run มี Throughput สูงกว่าเดิม เพื่อให้แถวที่ดีที่สุดของบาง Product เปลี่ยน
+    batch['Throughput mill (kg/h)'] *= np.where(np.arange(rows) % 3 == 0, 1.5, 0.9)
+    batch['PO'] = [f"TEST{seed}-{i}" for i in range(rows)]
+    return batch
+
+
+def test_append_and_compact_match_full_rebuild():
+    rows = len(main.df)
+    for seed in range(3):
+        main.append_rows(new_batch(seed))
+        assert_index_matches_rebuild()
+    assert len(main.df) == rows + 600
+    before = rankings()
+    export = main.recommendation_export_body('csv')[1]
+
+    assert main.compact_rft_data() == 3
+    assert main.list_segments() == []
+    assert len(main.df.chunks) == 1 and len(main.df) == rows + 600
+    assert len(pd.read_csv(main.file_path)) == rows + 600
+    assert_index_matches_rebuild()
+    assert rankings() == before
+    assert main.recommendation_export_body('csv')[1] == export
+
+
+def test_segments_left_by_interrupted_compaction_are_skipped(monkeypatch):
+    main.append_rows(new_batch(10))
+    rows = len(main.df)
+    remove = os.remove
+
+    def fail_on_segments(path):
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(main.segment_dir):
+            raise OSError("interrupted")
+        remove(path)
+
+    # process หยุดหลังแทนที่ RFT 2024.csv แต่ยังไม่ได้ลบ segment
+    monkeypatch.setattr(main.os, "remove", fail_on_segments)
+    with pytest.raises(OSError):
+        main.compact_rft_data()
+    monkeypatch.setattr(main.os, "remove", remove)
+
+    assert os.listdir(main.segment_dir)
+    assert main.list_segments() == []
+    assert len(main.load_rft_data()) == rows
+
+
+def assert_arrays_match(actual, expected):
+    # ค่าทศนิยมที่เขียนลง CSV แล้วอ่านกลับอาจต่างกันที่หลักสุดท้าย
+    assert actual.keys() == expected.keys()
+    for name, values in expected.items():
+        if values.dtype.kind == 'f':
+            np.testing.assert_allclose(actual[name], values, rtol=1e-12)
+        else:
+            np.testing.assert_array_equal(actual[name], values)
+
+
+def test_snapshot_matches_csv():
+    main.build_snapshot()
+    assert not main.build_snapshot()
+    snapshot = main.load_snapshot()
+    assert snapshot is not None and snapshot.text and snapshot.base_indexes is not None
+    csv = main.RftData([main.prepare_rft_frame(pd.read_csv(main.file_path))])
+    pd.testing.assert_frame_equal(snapshot.frame(), csv.frame(), check_categorical=False)
+
+    labels = np.arange(0, len(csv), 7)
+    pd.testing.assert_frame_equal(snapshot.rows(labels, main.BEST_RUN_COLUMNS), csv.rows(labels, main.BEST_RUN_COLUMNS),
+                                  check_categorical=False)
+    indexes, expected = main.build_indexes(snapshot), main.build_indexes(csv)
+    assert_arrays_match(indexes[0].to_arrays(), expected[0].to_arrays())
+    assert_arrays_match(indexes[1].parts[0].to_arrays(), expected[1].parts[0].to_arrays())
+    assert_arrays_match(indexes[2].to_arrays(), expected[2].to_arrays())
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def sketch_state(sketch):
+    return (sketch.count, sketch.keys.tolist(), sketch.counts.tolist(), sketch.minimum, sketch.maximum)
+
+
+def product_state(stats, product):
+    groups = stats.product(product)
+    return {
+        key: (entry["runs"], entry["rft_passed"], *(sketch_state(entry[metric]) for metric in main.STATS_METRICS))
+        for key, entry in groups.items()
+    }
+
+
+def products(data):
+    return sorted(set(data['Product'].dropna().astype(str).str.upper()))
+
+
+@pytest.mark.parametrize("max_parts", [2, 8])
+def test_incremental_merge_equals_full_rebuild(monkeypatch, max_parts):
+    monkeypatch.setattr(main, "STATS_MAX_PARTS", max_parts)
+    data = main.df.frame()
+    cuts = np.linspace(len(data) // 2, len(data), 12).astype(int)
+    stats = main.build_throughput_stats(data.iloc[:cuts[0]])
+    for start, end in zip(cuts[:-1], cuts[1:]):
+        stats = main.merge_throughput_stats(stats, main.build_throughput_stats(data.iloc[start:end]))
+    assert len(stats.parts) <= max_parts
+
+    full = main.build_throughput_stats(data)
+    for product in products(data):
+        assert product_state(stats, product) == product_state(full, product)
+    assert stats.product("NOT-A-PRODUCT") is None
+
+
+def test_quantiles_within_accuracy():
+    data = main.df.frame()
+    passed = data[data['RFT-ext.'] & data['RFT-Mill']]
+    stats = main.build_throughput_stats(data)
+    for product in products(passed):
+        rows = passed[passed['Product'].astype(str).str.upper() == product]
+        totals = {metric: main.QuantileSketch() for metric in main.STATS_METRICS}
+        for entry in stats.product(product).values():
+            for metric in main.STATS_METRICS:
+                totals[metric] = totals[metric].merge(entry[metric])
+        for metric in main.STATS_METRICS:
+            values = np.sort(rows[metric].dropna().to_numpy(dtype=np.float64))
+            assert totals[metric].count == len(values)
+            for q in (0.5, 0.9):
+                if not len(values):
+                    continue
+                exact = values[max(int(np.ceil(q * len(values))) - 1, 0)]
+                assert totals[metric].quantile(q) == pytest.approx(exact, rel=main.SKETCH_ACCURACY, abs=1e-9)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_quantiles_match_percentile_on_random_values(seed):
+    rng = np.random.default_rng(seed)
+    rows = int(rng.integers(1, 3000))
+    # ค่ากระจายหลายช่วง รวมค่า 0 และค่าว่าง
+    values = np.where(rng.random(rows) < 0.05, 0.0, rng.lognormal(5, 1.5, rows))
+    values[rng.random(rows) < 0.05] = np.nan
+    data = pd.DataFrame({
+        'Product': rng.choice(['A', 'B'], rows),
+        'Line': rng.integers(1, 3, rows).astype(np.float32),
+        'Mill': rng.integers(1, 3, rows).astype(np.float32),
+        'RFT-ext.': np.ones(rows, dtype=bool),
+        'RFT-Mill': np.ones(rows, dtype=bool),
+        **{metric: values for metric in main.STATS_METRICS},
+    })
+
+    stats = main.build_throughput_stats(data)
+    for product in ('A', 'B'):
+        groups = stats.product(product)
+        if groups is None:
+            continue
+        for (line, mill), entry in groups.items():
+            picked = data[(data['Product'] == product) & (data['Line'] == line) & (data['Mill'] == mill)]
+            exact = picked[main.STATS_METRICS[0]].dropna().to_numpy()
+            sketch = entry[main.STATS_METRICS[0]]
+            assert sketch.count == len(exact)
+            if not len(exact):
+                continue
+            assert sketch.minimum == exact.min() and sketch.maximum == exact.max()
+            for q in (0.1, 0.5, 0.9, 0.99):
+                expected = np.percentile(exact, q * 100, method='inverted_cdf')
+                assert sketch.quantile(q) == pytest.approx(expected, rel=main.SKETCH_ACCURACY, abs=1e-9)